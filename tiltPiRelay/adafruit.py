@@ -1,10 +1,18 @@
+import os
+import re
+import json
 import time
 import requests
 import logging
+import threading
+import paho.mqtt.client as mqtt
 from datetime import datetime, timezone
 from collections import defaultdict
-from Adafruit_IO import Client, Feed, Group, errors
-from queue import SimpleQueue
+from Adafruit_IO import Client, Data, errors
+from ringq import RingQueue
+from spool import Spool
+from aggregate import Aggregator
+from feedcache import FeedCatalog, permanent
 
 
 """
@@ -12,24 +20,225 @@ IO.Adafruit reporter class
 
 Reports data points from queues to io.adafruit.com
 
+Data points normally arrive through a reader of an Ingest channel (see
+ingest.py); the upload thread sleeps until something is put into the
+channel and then drains everything that is ready in one pass.  Plain
+queues can still be added with add_q(); those are polled.
+
+Every sample is fed through a windowed aggregator (see aggregate.py) so
+each reporting interval uploads a summary of the samples which arrived
+during it (the mean, or the full min/max/mean/last/count set) rather
+than whichever sample happened to arrive first.
+
+In batch mode the values of every feed for a reporting interval are
+posted to the group data endpoint in a single request per cycle instead
+of one request per feed.  Batches are split into requests of at most
+max_batch feeds.
+
+Values are written to an on-disk spool before they are uploaded.  When
+the upload fails they stay there and are replayed in bulk, in order and
+with their original timestamps, once io.adafruit.com is reachable again.
+
+The data is sent with a pluggable transport: 'rest' makes an HTTPS
+request per upload with Adafruit_IO.Client; 'mqtt' publishes over one
+persistent MQTT connection (QoS 1) which avoids a TLS request per upload.
+
 """
 
 logger = logging.getLogger('tiltpirelay.adafruit')
 DEFAULT_REPORT_INTERVAL_S = 55
 DEFAULT_GROUP_NAME='garage'
+DEFAULT_MAX_BATCH = 20
+DEFAULT_REPLAY_MAX = 500
+DEFAULT_SPOOL_FILE = os.path.expanduser('~/.beercntlr.spool')
+DEFAULT_FEED_CACHE = os.path.expanduser('~/.beercntlr.feeds.json')
+
+TRANSPORTS = ['rest', 'mqtt']
+DEFAULT_MQTT_HOST = 'io.adafruit.com'
+DEFAULT_MQTT_PORT = 8883
+MQTT_KEEPALIVE_S = 60
+MQTT_MAX_INFLIGHT = 20
+MQTT_ACK_TIMEOUT_S = 10
+MQTT_THROTTLE_S = 30
+# Spooled values of a feed (or batch) are dropped after this many permanent (4xx)
+# rejections in a row, so they don't block the spool forever
+MAX_REJECTS = 5
+
+class TransportError(Exception):
+  """ Transport isn't connected or didn't get an acknowledgement in time """
+  pass
+
+def feed_key(name):
+  """ Key io.adafruit.com generates for a feed name """
+  return re.sub(r'[^a-z0-9-]', '-', name.lower())
+
+class RestTransport:
+  """ Sends data with the REST API; one HTTPS request per call """
+  creates_feeds = False
+
+  def __init__(self, aio):
+    self._aio = aio
+
+  def send_group(self, group, values, created_at):
+    self._aio._post(f"groups/{group}/data",
+                    {'feeds': [{'key': k, 'value': v} for (k, v) in values],
+                     'created_at': created_at})
+
+  def send_feed(self, key, points):
+    self._aio.send_batch_data(key, [Data(value=v, created_at=c) for (v, c) in points])
+
+  def close(self):
+    pass
+
+class MqttTransport:
+  """
+  Publishes data over one long-lived MQTT connection with QoS 1.  Each
+  call waits for the broker to acknowledge every message it published
+  (tracked locally by message id) and raises TransportError when it
+  doesn't.  paho reconnects automatically when the connection drops.
+  The broker creates feeds on first publish.
+
+  paho calls _on_publish with its own message lock held, so publish() is
+  never called with self._lock held; an ack which arrives before the
+  message id is recorded is kept in _early.
+  """
+  creates_feeds = True
+
+  def __init__(self, user, key, host=DEFAULT_MQTT_HOST, port=DEFAULT_MQTT_PORT, tls=True):
+    self._user = user
+    self._connected = threading.Event()
+    self._inflight = {}
+    self._early = set()  # acked before _publish recorded them
+    self._lock = threading.Lock()
+    self._throttled_until = 0
+    self.stats = { 'published': 0, 'acked': 0, 'disconnects': 0 }
+
+    self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    self._client.username_pw_set(user, key)
+    if tls:
+      self._client.tls_set()
+    self._client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+    self._client.reconnect_delay_set(min_delay=1, max_delay=120)
+    self._client.on_connect = self._on_connect
+    self._client.on_disconnect = self._on_disconnect
+    self._client.on_publish = self._on_publish
+    self._client.on_message = self._on_message
+    self._client.connect_async(host, port, keepalive=MQTT_KEEPALIVE_S)
+    self._client.loop_start()
+
+  def _on_connect(self, client, userdata, flags, reason_code, properties):
+    if reason_code.is_failure:
+      logger.error(f"MQTT connect failed: {reason_code}")
+      return
+    logger.info("MQTT connected")
+    client.subscribe([(f"{self._user}/throttle", 1), (f"{self._user}/errors", 1)])
+    self._connected.set()
+
+  def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+    logger.warning(f"MQTT disconnected: {reason_code}")
+    self._connected.clear()
+    self.stats['disconnects'] += 1
+
+  def _on_publish(self, client, userdata, mid, reason_code, properties):
+    with self._lock:
+      self.stats['acked'] += 1
+      if self._inflight.pop(mid, None) is None:
+        self._early.add(mid)
+
+  def _on_message(self, client, userdata, msg):
+    logger.error(f"MQTT {msg.topic}: {msg.payload.decode(errors='replace')}")
+    if msg.topic.endswith('/throttle'):
+      self._throttled_until = time.time() + MQTT_THROTTLE_S
+
+  def _publish(self, messages):
+    """ Publish (topic, payload) messages and wait for all of them to be acknowledged """
+    if self._throttled_until > time.time():
+      raise errors.ThrottlingError()
+    if not self._connected.wait(MQTT_ACK_TIMEOUT_S):
+      raise TransportError("MQTT not connected")
+    infos = []
+    for (topic, payload) in messages:
+      info = self._client.publish(topic, json.dumps(payload), qos=1)
+      if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        raise TransportError(f"MQTT publish failed: {mqtt.error_string(info.rc)}")
+      with self._lock:
+        if info.mid in self._early:
+          self._early.discard(info.mid)
+        else:
+          self._inflight[info.mid] = topic
+      self.stats['published'] += 1
+      infos.append(info)
+    deadline = time.monotonic() + MQTT_ACK_TIMEOUT_S
+    for info in infos:
+      info.wait_for_publish(max(0, deadline - time.monotonic()))
+      if not info.is_published():
+        raise TransportError(f"MQTT publish {info.mid} not acknowledged")
+
+  def send_group(self, group, values, created_at):
+    self._publish([(f"{self._user}/groups/{group}",
+                    {'feeds': dict(values), 'created_at': created_at})])
+
+  def send_feed(self, key, points):
+    self._publish([(f"{self._user}/feeds/{key}", {'value': v, 'created_at': c})
+                   for (v, c) in points])
+
+  def inflight(self):
+    with self._lock:
+      return len(self._inflight)
+
+  def close(self):
+    self._client.disconnect()
+    self._client.loop_stop()
 
 class IOAdafruit:
   
-  def __init__(self, user, key, interval=DEFAULT_REPORT_INTERVAL_S, group=DEFAULT_GROUP_NAME):
+  def __init__(self, user, key, interval=DEFAULT_REPORT_INTERVAL_S, group=DEFAULT_GROUP_NAME,
+               batch=False, max_batch=DEFAULT_MAX_BATCH, spool=DEFAULT_SPOOL_FILE,
+               replay_max=DEFAULT_REPLAY_MAX, aggregate='mean', channel=None,
+               transport='rest', mqtt_host=DEFAULT_MQTT_HOST, mqtt_port=DEFAULT_MQTT_PORT,
+               mqtt_tls=True, feed_cache=DEFAULT_FEED_CACHE):
+    if transport not in TRANSPORTS:
+      raise ValueError(f"Unknown transport: {transport}")
     self._user = user
     self._key = key
     self._interval = interval
     self._group = group
+    self._batch = batch
+    self._max_batch = max(1, max_batch)
+    self._replay_max = max(1, replay_max)
+    self._spool = spool if isinstance(spool, Spool) else Spool(spool)
+    self._backoff_until = 0
+    self._agg = Aggregator(interval, aggregate)
     self._run = True
+    self._channel = channel
+    self._transport_name = transport
+    self._mqtt = (mqtt_host, mqtt_port, mqtt_tls)
+    self._transport = None
+    self._feed_cache = feed_cache
+    self._catalog = None
     self._qs = []
+    self._rejects = {}    # feed -> permanent failures in a row
+    self._rejected = None # status of the last request if it was a permanent failure
+    self._stats = { 'requests': 0,  # HTTP requests made to send data
+                    'rejected': 0,  # values dropped after MAX_REJECTS
+                    'values': 0,    # feed values successfully sent
+                    'saved': 0,     # requests avoided by batching
+                    'upload_lag': 0 } # age of the newest value uploaded
+
+  def stats(self):
+    stats = dict(self._stats)
+    stats['spooled'] = self._spool.count()
+    stats['spool_dropped'] = self._spool.dropped()
+    if self._channel:
+      stats['sources'] = self._channel.stats()
+    if isinstance(self._transport, MqttTransport):
+      stats['mqtt'] = dict(self._transport.stats, inflight=self._transport.inflight())
+    return stats
 
   def end(self):
     self._run = False
+    if self._channel:
+      self._channel.wake()
 
   def add_q(self, q):
     self._qs.append(q)
@@ -37,82 +246,288 @@ class IOAdafruit:
   def control_thread(self):
     aio = Client(self._user, self._key)
     #aio.set_timeout(30)
-    feeds = {}
-    last_update = defaultdict(lambda: 0)
 
+    # Feed keys come from the on-disk cache; the catalog refreshes it
+    # and creates missing feeds in the background
+    self._catalog = FeedCatalog(aio, self._group, self._feed_cache)
+    self._catalog.start()
+
+    if self._transport_name == 'mqtt':
+      (host, port, tls) = self._mqtt
+      self._transport = MqttTransport(self._user, self._key, host, port, tls)
+    else:
+      self._transport = RestTransport(aio)
+
+    # The spool may hold a backlog from before a restart
+    retry = True
+    while self._run:
+      # Sleep until data arrives, a window closes or the backoff expires
+      if self._collect(self._backoff_until if retry else None):
+        retry = True
+      if retry and self._backoff_until <= time.time():
+        retry = not self._replay()
+    self._catalog.end()
+    self._transport.close()
+
+  def _collect(self, wake_at=None):
+    """
+    Wait for data (until the current window closes, or wake_at if that
+    is sooner), aggregate everything which is ready and spool the closed
+    windows.  Returns True if anything was added to the spool.
+    """
+    now = time.time()
+    timeout = self._agg.window_start(now) + self._interval - now
+    if wake_at is not None:
+      timeout = min(timeout, max(0, wake_at - now))
+    if self._qs:
+      timeout = min(timeout, 1.0)
+    if self._channel:
+      self._channel.wait(timeout)
+    else:
+      time.sleep(timeout)
+
+    items = self._channel.drain() if self._channel else []
+    for q in self._qs:
+      while not q.empty():
+        items.append(q.get())
+
+    rows = []
+    for data in items:
+      for (feedkey, value) in data.feeds():
+        rows.extend(self._agg.add(data.timestamp, feedkey, value))
+    # Report every window which has closed
+    rows.extend(self._agg.flush(time.time()))
+
+    if rows:
+      self._spool.append(rows)
+      self._spool.prune()
+    return bool(rows)
+
+  def _replay(self):
+    """
+    Upload spooled values in the order they were recorded with their
+    original timestamps.  Stops at the first failure; anything not sent
+    stays in the spool for the next pass.  Returns True once the spool
+    is empty.
+    """
+    while self._run:
+      rows = self._spool.peek(self._replay_max)
+      if not rows:
+        return True
+      if self._batch:
+        sent = self._send_groups(rows)
+      else:
+        sent = self._send_feeds(rows)
+      self._spool.ack(sent)
+      if sent:
+        sent_ids = set(sent)
+        self._stats['upload_lag'] = time.time() - max(r[1] for r in rows if r[0] in sent_ids)
+      if len(sent) < len(rows):
+        return False
+      logger.debug(f"Uploaded {len(sent)} values; {self._spool.count()} left in spool")
+    return False
+
+  def _send_groups(self, rows):
+    """
+    Send rows to the group; one request or message per timestamp per
+    max_batch feeds.  Returns the ids of the rows which were sent.
+    """
+    by_time = defaultdict(list)
+    for row in rows:
+      by_time[row[1]].append(row)
+
+    sent = []
+    for ts, group in by_time.items():
+      created_at = datetime.fromtimestamp(ts, timezone.utc).isoformat()
+      for start in range(0, len(group), self._max_batch):
+        chunk = group[start:start + self._max_batch]
+        # Group data endpoint takes the feed key relative to the group
+        batch = []
+        for (_, _, k, v) in chunk:
+          key = self._catalog.key(k)
+          if key is None:
+            self._catalog.want(k)
+            key = feed_key(k)
+          batch.append((key.split('.')[-1], v))
+        feeds = tuple(k for (_, _, k, _) in chunk)
+        if not self._call(f"batch of {len(chunk)}", self._transport.send_group,
+                          self._group, batch, created_at):
+          if self._rejected is None or not self._reject(feeds, chunk, f"batch of {len(chunk)}"):
+            return sent
+          continue
+        self._rejects.pop(feeds, None)
+        sent.extend(row[0] for row in chunk)
+        self._stats['requests'] += 1
+        self._stats['values'] += len(chunk)
+        self._stats['saved'] += len(chunk) - 1
+        logger.debug(f"  Sent batch: {batch} at {created_at}")
+    logger.info(f"Batch upload stats: {self._stats}")
+    return sent
+
+  def _send_feeds(self, rows):
+    """
+    Send rows to each feed; one request per feed (REST) or one message
+    per row (MQTT).  Feeds which don't exist yet are skipped (and left in
+    the spool) until the catalog has created them; a feed it can't
+    create counts as a rejection.  Returns the ids of the rows which
+    were sent.
+    """
+    by_feed = defaultdict(list)
+    for row in rows:
+      by_feed[row[2]].append(row)
+
+    sent = []
+    for feedkey, group in by_feed.items():
+      key = self._catalog.key(feedkey)
+      if key is None:
+        if not self._transport.creates_feeds:
+          self._catalog.want(feedkey)
+          self._backoff_until = time.time() + 5
+          self._rejected = self._catalog.failed(feedkey)
+          if self._rejected is not None:
+            self._reject(feedkey, group, f"{feedkey} feed")
+          continue
+        key = f"{self._group}.{feed_key(feedkey)}"
+      points = [(v, datetime.fromtimestamp(ts, timezone.utc).isoformat())
+                for (_, ts, _, v) in group]
+      if not self._call(f"{feedkey} data", self._transport.send_feed, key, points):
+        if self._rejected is None or not self._reject(feedkey, group, feedkey):
+          return sent
+        continue
+      self._rejects.pop(feedkey, None)
+      sent.extend(row[0] for row in group)
+      self._stats['requests'] += 1
+      self._stats['values'] += len(group)
+      self._stats['saved'] += len(group) - 1
+      logger.debug(f"  Sent {len(group)} values to {key}")
+    return sent
+
+  def _reject(self, key, rows, what):
+    """
+    Count a permanent (4xx) rejection of rows; a bad key, quota or
+    similar, which retrying won't fix.  After MAX_REJECTS in a row for
+    the same key the rows are dropped from the spool so they don't block
+    it forever.  Returns True if they were dropped.
+    """
+    n = self._rejects[key] = self._rejects.get(key, 0) + 1
+    if n < MAX_REJECTS:
+      return False
+    logger.error(f"  {what} rejected {n} times ({self._rejected}); " +
+                 f"dropping {len(rows)} spooled values")
+    self._spool.ack([row[0] for row in rows])
+    self._stats['rejected'] += len(rows)
+    del self._rejects[key]
+    return True
+
+  def _call(self, what, fn, *args, **kwargs):
+    """
+    Make an AIO request.  On failure log it, set the backoff time and
+    return None.
+    """
+    self._rejected = None
     try:
-      g = aio.groups(self._group)
-    except errors.RequestError:
-      logger.warning(f"Creating AIO group: {self._group}")
-      g = aio.create_group(Group(name=self._group))
+      return fn(*args, **kwargs) or True
+    except errors.ThrottlingError:
+      logger.error(f"  Got throttled sending {what}; wait 30 seconds")
+      self._backoff_until = time.time() + 30
+    except errors.RequestError as e:
+      logger.error(f"  Failed to send {what} (request error: {e})")
+      self._backoff_until = time.time() + 5
+      self._rejected = permanent(e)
     except requests.exceptions.ConnectionError:
-      logger.error("  Failed to query AIO groups (connection error)")
+      logger.error(f"  Failed to send {what} (connection error)")
+      self._backoff_until = time.time() + 5
     except requests.exceptions.ReadTimeout:
-      logger.error("  Failed to query AIO groups (timeout)")
+      logger.error(f"  Failed to send {what} (timeout)")
+      self._backoff_until = time.time() + 5
+    except TransportError as e:
+      logger.error(f"  Failed to send {what} ({e})")
+      self._backoff_until = time.time() + 5
+    return None
 
-    for f in g.feeds:
-      feeds[f.name] = f
-
-    while self._run:
-      for i,q in enumerate(self._qs):
-        if not q.empty():
-          data = q.get()
-          name = data['name']
-          delta = data['timestamp'] - last_update[name]
-          if delta > self._interval:
-            logger.info(f"Reporting data [delta: {delta}]: {data} (Queue-{i} size: {q.qsize()})")
-            for k in data:
-              if k == 'name' or k == 'timestamp':
-                continue
-              feedkey = name + '-' + k
-              if not feedkey in feeds:
-                logger.warning(f"  Creating new feed: {feeds[feedkey].key}")
-                feeds[feedkey] = aio.create_feed(Feed(name=feedkey), group_key=self._group)
-              try:
-                aio.send(feeds[feedkey].key, data[k])
-                last_update[name] = data['timestamp']
-                logger.debug(f"  Sent '{data[k]}' to {feeds[feedkey].key}")
-              except errors.RequestError:
-                logger.error("  Failed to send {feedkey} data (request error)")
-                time.sleep(5)
-                continue
-              except requests.exceptions.ConnectionError:
-                logger.error("  Failed to send {feedkey} data (connection error)")
-                time.sleep(5)
-                continue
-              except requests.exceptions.ReadTimeout:
-                logger.error("  Failed to send {feedkey} data (timeout)")
-                time.sleep(5)
-                continue
-              except errors.ThrottlingError:
-                logger.error("  Got throttled sending {feedkey} data; wait 30 seconds")
-                time.sleep(30)
-                continue
-          else:
-            logger.debug(f"Dropping data [delta: {delta}]: {data} (Queue-{i} size: {q.qsize()})")
-        else:
-          logger.debug(f"Queue-{i} is empty")
-      time.sleep(1)
-        
 if __name__ == "__main__":
 
-  import threading
+  import sys
   import random
+  import socketserver
+  from sample import Sample, Schema
+
+  logging.basicConfig(level=logging.DEBUG)
+
+  if len(sys.argv) > 1 and sys.argv[1] == 'mqtt':
+    # Publish a backlog over MQTT to a minimal local QoS 1 broker and
+    # check that every message is acknowledged
+    BACKLOG = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    logging.getLogger().setLevel(logging.INFO)
+
+    class StubBroker(socketserver.BaseRequestHandler):
+      received = 0
+
+      def packet(self):
+        head = self.request.recv(1)
+        if not head:
+          return (None, b'')
+        (length, shift) = (0, 0)
+        while True:
+          b = self.request.recv(1)[0]
+          length |= (b & 0x7f) << shift
+          shift += 7
+          if not b & 0x80:
+            break
+        body = b''
+        while len(body) < length:
+          body += self.request.recv(length - len(body))
+        return (head[0], body)
+
+      def handle(self):
+        while True:
+          (kind, body) = self.packet()
+          if kind is None or kind >> 4 == 14:    # DISCONNECT
+            return
+          if kind >> 4 == 1:                     # CONNECT
+            self.request.sendall(bytes([0x20, 2, 0, 0]))
+          elif kind >> 4 == 8:                   # SUBSCRIBE
+            (pid, n) = (body[:2], 0)
+            i = 2
+            while i < len(body):
+              i += 2 + int.from_bytes(body[i:i + 2], 'big') + 1
+              n += 1
+            self.request.sendall(bytes([0x90, 2 + n]) + pid + bytes([1] * n))
+          elif kind >> 4 == 3:                   # PUBLISH
+            StubBroker.received += 1
+            if (kind >> 1) & 3:
+              i = 2 + int.from_bytes(body[:2], 'big')
+              self.request.sendall(bytes([0x40, 2]) + body[i:i + 2])
+          elif kind >> 4 == 12:                  # PINGREQ
+            self.request.sendall(bytes([0xd0, 0]))
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StubBroker)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
 
-  logger.basicConfig(level=logging.DEBUG)
+    transport = MqttTransport('myusername', 'aio_mysecretkeyforaioaccess',
+                              '127.0.0.1', server.server_address[1], tls=False)
+    begin = time.monotonic()
+    now = datetime.now(timezone.utc).isoformat()
+    transport.send_feed('myusername.test', [(i, now) for i in range(BACKLOG)])
+    elapsed = time.monotonic() - begin
+    print(f"{BACKLOG} messages in {elapsed:.2f}s: {transport.stats}, " +
+          f"{transport.inflight()} in flight, broker received {StubBroker.received}")
+    transport.close()
+    ok = transport.stats['acked'] == BACKLOG and transport.inflight() == 0
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
 
   io = IOAdafruit('myusername', 'aio_mysecretkeyforaioaccess')
 
-  q = SimpleQueue()
+  q = RingQueue()
   io.add_q(q)
 
   thread = threading.Thread(target=io.control_thread, daemon=True)
   thread.start()
 
+  schema = Schema('test', ('vala', 'valb'))
   while True:
     d = random.uniform(-10, 110)
-    q.put({'timestamp': datetime.now(timezone.utc).timestamp(),
-           'name': 'test',
-           'vala': d,
-           'valb': d/2})
+    q.put(Sample(schema, (d, d/2)))
     time.sleep(5)
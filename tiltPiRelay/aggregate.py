@@ -0,0 +1,88 @@
+import logging
+
+"""
+Windowed aggregation classes
+
+Summarises every sample a feed receives during a reporting window instead
+of keeping one arbitrary snapshot.  Each feed keeps a running min, max,
+sum, last value and count for the current window, so memory use doesn't
+depend on how many samples arrive.
+
+Windows are aligned to multiples of the interval so all the feeds close
+their windows at the same time.  A closed window reports either just the
+mean (as the feed itself) or the full set, where min, max, last and count
+are reported as separate feeds ('<feed>-min', '<feed>-max', ...).
+
+"""
+
+logger = logging.getLogger('tiltpirelay.aggregate')
+
+MODES = ['mean', 'full']
+STATS = ['min', 'max', 'last', 'count']
+
+class Window:
+  __slots__ = ('start', 'min', 'max', 'sum', 'last', 'count')
+
+  def __init__(self, start, value):
+    self.start = start
+    self.min = value
+    self.max = value
+    self.sum = value
+    self.last = value
+    self.count = 1
+
+  def add(self, value):
+    if value < self.min:
+      self.min = value
+    if value > self.max:
+      self.max = value
+    self.sum += value
+    self.last = value
+    self.count += 1
+
+  def mean(self):
+    return self.sum / self.count
+
+class Aggregator:
+
+  def __init__(self, interval, mode='mean'):
+    if mode not in MODES:
+      raise ValueError(f"Unknown aggregation mode: {mode}")
+    self._interval = interval
+    self._mode = mode
+    self._windows = {}
+
+  def window_start(self, ts):
+    return ts - (ts % self._interval)
+
+  def add(self, ts, feedkey, value):
+    """ Add a sample; returns rows for the feed's window if ts closed it """
+    start = self.window_start(ts)
+    w = self._windows.get(feedkey)
+    if w is None:
+      self._windows[feedkey] = Window(start, value)
+      return []
+    if w.start == start:
+      w.add(value)
+      return []
+    self._windows[feedkey] = Window(start, value)
+    return self._report(feedkey, w)
+
+  def flush(self, now):
+    """
+    Close every window which ended before now.
+    Returns a list of (timestamp, feedkey, value) rows.
+    """
+    rows = []
+    start = self.window_start(now)
+    for feedkey in [k for k, w in self._windows.items() if w.start < start]:
+      rows.extend(self._report(feedkey, self._windows.pop(feedkey)))
+    return rows
+
+  def _report(self, feedkey, w):
+    logger.debug(f"{feedkey} window {w.start}: n={w.count} min={w.min} "
+                 f"max={w.max} mean={w.mean()} last={w.last}")
+    rows = [(w.start, feedkey, w.mean())]
+    if self._mode == 'full':
+      rows.extend((w.start, f"{feedkey}-{s}", getattr(w, s)) for s in STATS)
+    return rows
@@ -0,0 +1,285 @@
+import time
+import random
+import asyncio
+import logging
+import aiohttp
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+from adafruit import IOAdafruit, feed_key, DEFAULT_REPORT_INTERVAL_S, DEFAULT_GROUP_NAME
+
+"""
+Asyncio IO.Adafruit reporter class
+
+Drop in replacement for IOAdafruit (same add_q/end/control_thread
+interface) which uploads with asyncio instead of the blocking
+Adafruit_IO.Client.  Collection, aggregation and spooling are shared
+with IOAdafruit; only the upload side is different:
+
+  * one aiohttp session with a keep-alive connection pool is used for
+    every request
+  * at most max_inflight requests are outstanding at once
+  * a token bucket keeps the request rate under the account's data rate
+    limit (rate_limit requests per minute) instead of waiting to be
+    throttled; a 429 pauses the bucket, since throttling applies to the
+    whole account
+  * each feed has its own backoff, so a feed which is failing doesn't
+    hold up the others
+
+Each feed's spooled backlog is posted to its batch data endpoint with the
+original timestamps.
+
+"""
+
+logger = logging.getLogger('tiltpirelay.aioadafruit')
+
+DEFAULT_BASE_URL = 'https://io.adafruit.com'
+DEFAULT_RATE_LIMIT = 30   # requests per minute (free account)
+DEFAULT_MAX_INFLIGHT = 4
+KEEPALIVE_S = 120
+REQUEST_TIMEOUT_S = 30
+
+BACKOFF_MIN_S = 5
+BACKOFF_MAX_S = 600
+THROTTLE_BACKOFF_S = 30
+
+def retry_after(value, default=THROTTLE_BACKOFF_S):
+  """ Seconds to wait for a Retry-After header: seconds or an HTTP date """
+  if value is None:
+    return default
+  try:
+    return min(BACKOFF_MAX_S, max(0.0, float(value)))
+  except ValueError:
+    pass
+  try:
+    when = parsedate_to_datetime(value)
+  except (TypeError, ValueError, IndexError):
+    return default
+  if when.tzinfo is None:
+    when = when.replace(tzinfo=timezone.utc)
+  return min(BACKOFF_MAX_S, max(0.0, (when - datetime.now(timezone.utc)).total_seconds()))
+
+class TokenBucket:
+  """ Allow rate tokens per period seconds with bursts of up to burst """
+
+  def __init__(self, rate, period=60.0, burst=None):
+    self._rate = rate / period
+    self._burst = burst or max(1, rate // 4)
+    self._tokens = self._burst
+    self._last = time.monotonic()
+
+  def _refill(self):
+    now = time.monotonic()
+    # _last is in the future while paused
+    if now > self._last:
+      self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+      self._last = now
+
+  async def acquire(self):
+    while True:
+      self._refill()
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return
+      await asyncio.sleep(max(0, self._last - time.monotonic()) +
+                          (1 - self._tokens) / self._rate)
+
+  def pause(self, delay):
+    """ Hand out no tokens for the next delay seconds """
+    self._refill()
+    self._tokens = 0
+    self._last = max(self._last, time.monotonic() + delay)
+
+class FeedBackoff:
+  __slots__ = ('until', 'delay', 'failures')
+
+  def __init__(self):
+    self.until = 0
+    self.delay = 0
+    self.failures = 0
+
+  def failed(self, delay=None):
+    self.failures += 1
+    if delay is None:
+      self.delay = min(BACKOFF_MAX_S, max(BACKOFF_MIN_S, self.delay * 2))
+      delay = self.delay * random.uniform(0.8, 1.2)
+    self.until = time.monotonic() + delay
+
+  def succeeded(self):
+    self.delay = 0
+    self.until = 0
+
+  def ready(self):
+    return self.until <= time.monotonic()
+
+class AsyncIOAdafruit(IOAdafruit):
+
+  def __init__(self, user, key, interval=DEFAULT_REPORT_INTERVAL_S, group=DEFAULT_GROUP_NAME,
+               rate_limit=DEFAULT_RATE_LIMIT, max_inflight=DEFAULT_MAX_INFLIGHT,
+               base_url=DEFAULT_BASE_URL, **kwargs):
+    super().__init__(user, key, interval=interval, group=group, **kwargs)
+    self._rate_limit = rate_limit
+    self._max_inflight = max_inflight
+    self._base_url = base_url.rstrip('/')
+    self._backoff = {}
+    self._created = set()
+    self._stats['throttled'] = 0
+    self._stats['failures'] = 0
+
+  def control_thread(self):
+    asyncio.run(self._main())
+
+  async def _main(self):
+    loop = asyncio.get_running_loop()
+    self._bucket = TokenBucket(self._rate_limit)
+    self._inflight = asyncio.Semaphore(self._max_inflight)
+    connector = aiohttp.TCPConnector(limit=self._max_inflight,
+                                     keepalive_timeout=KEEPALIVE_S)
+    async with aiohttp.ClientSession(connector=connector,
+                                     headers={'X-AIO-Key': self._key},
+                                     timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S)) as session:
+      # The spool may hold a backlog from before a restart
+      retry = True
+      while self._run:
+        # Waiting on the channel blocks; keep it off the event loop
+        if await loop.run_in_executor(None, self._collect, self._next_retry() if retry else None):
+          retry = True
+        if retry:
+          retry = not await self._upload(session)
+
+  def _next_retry(self):
+    """
+    Wall clock time the first spooled feed can be retried (now if one is
+    ready, None if nothing is spooled)
+    """
+    feeds = self._spool.feeds()
+    if not feeds:
+      return None
+    backoffs = [self._backoff.get(f) for f in feeds]
+    if any(b is None or b.ready() for b in backoffs):
+      return time.time()
+    soonest = min(b.until for b in backoffs)
+    return time.time() + max(0, soonest - time.monotonic())
+
+  async def _upload(self, session):
+    """
+    Upload the backlog of every feed which isn't backing off.
+    Returns True once the spool is empty.
+    """
+    feeds = [f for f in self._spool.feeds()
+             if self._backoff.setdefault(f, FeedBackoff()).ready()]
+    await asyncio.gather(*(self._upload_feed(session, f) for f in feeds))
+    return self._spool.count() == 0
+
+  async def _upload_feed(self, session, feedkey):
+    backoff = self._backoff[feedkey]
+    while self._run:
+      rows = self._spool.peek(self._replay_max, feedkey)
+      if not rows:
+        return
+      async with self._inflight:
+        await self._bucket.acquire()
+        ok = await self._post_rows(session, feedkey, rows)
+      if not ok:
+        return
+      backoff.succeeded()
+      self._spool.ack([r[0] for r in rows])
+      self._stats['requests'] += 1
+      self._stats['values'] += len(rows)
+      self._stats['saved'] += len(rows) - 1
+      self._stats['upload_lag'] = time.time() - rows[-1][1]
+      logger.debug(f"  Sent {len(rows)} values to {feedkey}")
+
+  async def _post_rows(self, session, feedkey, rows):
+    key = f"{feed_key(self._group)}.{feed_key(feedkey)}"
+    url = f"{self._base_url}/api/v2/{self._user}/feeds/{key}/data/batch"
+    data = {'data': [{'value': v,
+                      'created_at': datetime.fromtimestamp(ts, timezone.utc).isoformat()}
+                     for (_, ts, _, v) in rows]}
+    backoff = self._backoff[feedkey]
+    try:
+      async with session.post(url, json=data) as resp:
+        if resp.status == 404 and feedkey not in self._created:
+          await self._create_feed(session, feedkey)
+          return False
+        if resp.status == 429:
+          self._stats['throttled'] += 1
+          delay = retry_after(resp.headers.get('Retry-After'))
+          logger.error(f"  Got throttled sending {feedkey} data; wait {delay:.0f} seconds")
+          backoff.failed(delay)
+          # The rate limit is per account; hold the other feeds too
+          self._bucket.pause(delay)
+          return False
+        if resp.status >= 400:
+          self._stats['failures'] += 1
+          logger.error(f"  Failed to send {feedkey} data (HTTP {resp.status})")
+          backoff.failed()
+          return False
+        return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      self._stats['failures'] += 1
+      logger.error(f"  Failed to send {feedkey} data ({type(e).__name__})")
+      backoff.failed()
+      return False
+
+  async def _create_feed(self, session, feedkey):
+    logger.warning(f"  Creating new feed: {feedkey}")
+    url = f"{self._base_url}/api/v2/{self._user}/groups/{feed_key(self._group)}/feeds"
+    try:
+      async with session.post(url, json={'feed': {'name': feedkey}}) as resp:
+        if resp.status < 400:
+          self._created.add(feedkey)
+        else:
+          logger.error(f"  Failed to create feed {feedkey} (HTTP {resp.status})")
+          self._backoff[feedkey].failed()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      logger.error(f"  Failed to create feed {feedkey} ({type(e).__name__})")
+      self._backoff[feedkey].failed()
+
+if __name__ == "__main__":
+
+  # Run the uploader against a local stub of the io.adafruit.com API which
+  # throttles or fails some of the requests
+  import json
+  import tempfile
+  import threading
+  from email.utils import formatdate
+  from ringq import RingQueue
+  from sample import Sample, Schema
+  from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+  logging.basicConfig(level=logging.DEBUG)
+
+  class StubAIO(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+      body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+      r = random.random()
+      status = 429 if r < 0.1 else 500 if r < 0.15 else 200
+      print(f"stub: {self.path} {len(body.get('data', []))} values -> {status}")
+      self.send_response(status)
+      if status == 429:
+        self.send_header('Retry-After', formatdate(time.time() + 10, usegmt=True))
+      self.send_header('Content-Length', '2')
+      self.end_headers()
+      self.wfile.write(b'{}')
+
+  server = ThreadingHTTPServer(('127.0.0.1', 0), StubAIO)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  io = AsyncIOAdafruit('myusername', 'aio_mysecretkeyforaioaccess', interval=5,
+                       base_url=f"http://127.0.0.1:{server.server_address[1]}",
+                       spool=tempfile.mktemp(suffix='.spool'))
+  q = RingQueue()
+  io.add_q(q)
+
+  thread = threading.Thread(target=io.control_thread, daemon=True)
+  thread.start()
+
+  schema = Schema('test', ('vala', 'valb'))
+  while True:
+    d = random.uniform(-10, 110)
+    q.put(Sample(schema, (d, d/2)))
+    time.sleep(0.25)
+    print(io.stats())
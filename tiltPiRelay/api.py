@@ -0,0 +1,202 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from tsdb import LEVELS
+
+"""
+Local query API
+
+Small read-only HTTP service on top of the local time series store so a
+phone or browser can plot the data without pulling every sample:
+
+  GET /feeds
+      ["ctrl-1-setpoint", "temp1-temp", ...]
+
+  GET /series?feed=ctrl-1-setpoint&from=&to=&points=500&method=lttb
+      {"feed": ..., "level": ..., "method": ..., "points": [[t, v], ...]}
+
+  GET /stats
+      {"ingest": {...}, "adafruit": {...}, ...}
+
+Feed names are the same ones used on io.adafruit.com (name + '-' + key).
+'from' and 'to' are epoch seconds or ISO 8601 times; 'to' defaults to the
+newest sample and 'from' to a day before 'to'.  The coarsest stored level
+(raw, 1m, 1h) which still has at least 'points' points in the range is
+read and then downsampled on the server to at most 'points' points with
+either LTTB (largest triangle three buckets, the default) or min/max
+buckets ([[t, min, max], ...]).
+
+Responses carry an ETag built from the request and the newest sample of
+the feed, so repeated polls with If-None-Match get a 304 without running
+the query.  /stats returns the counters of the running app (whatever the
+stats function given to QueryServer reports).
+
+"""
+
+logger = logging.getLogger('tiltpirelay.api')
+
+DEFAULT_PORT = 8080
+# The API has no authentication; only local clients unless configured otherwise
+DEFAULT_BIND = '127.0.0.1'
+DEFAULT_RANGE_S = 86400
+DEFAULT_POINTS = 500
+MAX_POINTS = 10000
+METHODS = ['lttb', 'minmax']
+
+def lttb(points, threshold):
+  """ Downsample [(t, v), ...] to threshold points keeping the visual shape """
+  n = len(points)
+  if threshold >= n or threshold < 3:
+    return points[:threshold]
+  sampled = [points[0]]
+  every = (n - 2) / (threshold - 2)
+  a = 0
+  for i in range(threshold - 2):
+    # Average of the next bucket is the third point of the triangle
+    nstart = int((i + 1) * every) + 1
+    nend = min(int((i + 2) * every) + 1, n)
+    avg_t = sum(p[0] for p in points[nstart:nend]) / (nend - nstart)
+    avg_v = sum(p[1] for p in points[nstart:nend]) / (nend - nstart)
+
+    start = int(i * every) + 1
+    end = int((i + 1) * every) + 1
+    (at, av) = points[a]
+    best = -1
+    for j in range(start, end):
+      area = abs((at - avg_t) * (points[j][1] - av) - (at - points[j][0]) * (avg_v - av))
+      if area > best:
+        best = area
+        a_next = j
+    sampled.append(points[a_next])
+    a = a_next
+  sampled.append(points[-1])
+  return sampled
+
+def minmax(points, buckets, start, end):
+  """
+  Downsample into time buckets of [t, min, max]; points are (t, v) or
+  rollups (t, mean, min, max, count)
+  """
+  if not points:
+    return []
+  width = (end - start) / buckets or 1
+  out = {}
+  for p in points:
+    (lo, hi) = (p[2], p[3]) if len(p) > 2 else (p[1], p[1])
+    b = min(buckets - 1, int((p[0] - start) / width))
+    if b in out:
+      out[b][1] = min(out[b][1], lo)
+      out[b][2] = max(out[b][2], hi)
+    else:
+      out[b] = [start + b * width, lo, hi]
+  return [out[b] for b in sorted(out)]
+
+def parse_time(value):
+  try:
+    return float(value)
+  except ValueError:
+    return datetime.fromisoformat(value).timestamp()
+
+class QueryServer:
+
+  def __init__(self, store, port=DEFAULT_PORT, bind=DEFAULT_BIND, stats=None):
+    self._store = store
+    self._stats = stats
+    # Part of every ETag so they don't survive a restart
+    self._started = time.time()
+    self._httpd = ThreadingHTTPServer((bind, port), self._handler())
+    self._httpd.daemon_threads = True
+
+  def _handler(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        server.handle(self)
+
+      def log_message(self, fmt, *args):
+        logger.debug("%s - %s", self.address_string(), fmt % args)
+
+    return Handler
+
+  def serve_thread(self):
+    logger.info(f"Query API listening on port {self._httpd.server_address[1]}")
+    self._httpd.serve_forever()
+
+  def end(self):
+    # shutdown() blocks until serve_forever() returns; don't call it from that thread
+    threading.Thread(target=self._httpd.shutdown, daemon=True).start()
+
+  def handle(self, req):
+    url = urlparse(req.path)
+    args = { k: v[-1] for (k, v) in parse_qs(url.query).items() }
+    try:
+      if url.path == '/feeds':
+        self._reply(req, 200, self._store.feeds())
+      elif url.path == '/series':
+        self._series(req, args)
+      elif url.path == '/stats':
+        self._reply(req, 200, self._stats() if self._stats else {})
+      else:
+        self._reply(req, 404, {'error': 'not found'})
+    except (KeyError, ValueError, OverflowError, OSError) as e:
+      # OverflowError/OSError: times out of range for the store's partitions
+      self._reply(req, 400, {'error': f"bad request: {e}"})
+
+  def _series(self, req, args):
+    feed = args['feed']
+    points = max(1, min(MAX_POINTS, int(args.get('points', DEFAULT_POINTS))))
+    method = args.get('method', 'lttb')
+    if method not in METHODS:
+      raise ValueError(f"method must be one of {METHODS}")
+
+    last = self._store.last(feed)
+    end = parse_time(args['to']) if 'to' in args else (last or time.time())
+    start = parse_time(args['from']) if 'from' in args else end - DEFAULT_RANGE_S
+
+    etag = '"' + hashlib.sha1(repr((feed, start, end, points, method,
+                                    last if 'to' not in args or end >= (last or 0) else None,
+                                    self._started)).encode()).hexdigest() + '"'
+    if req.headers.get('If-None-Match') == etag:
+      req.send_response(304)
+      req.send_header('ETag', etag)
+      req.end_headers()
+      return
+
+    # Coarsest level which still has enough points to fill the request
+    level = 'raw'
+    for (name, period) in sorted(LEVELS.items(), key=lambda l: -l[1]):
+      if period and (end - start) / period >= points:
+        level = name
+        break
+
+    data = self._store.query(feed, start, end, level)
+    if method == 'minmax':
+      out = minmax(data, points, start, end)
+    else:
+      out = lttb([(p[0], p[1]) for p in data], points)
+
+    self._reply(req, 200, { 'feed': feed,
+                            'from': start,
+                            'to': end,
+                            'level': level,
+                            'method': method,
+                            'count': len(data),
+                            'points': out }, etag)
+
+  def _reply(self, req, status, body, etag=None):
+    data = json.dumps(body).encode()
+    req.send_response(status)
+    req.send_header('Content-Type', 'application/json')
+    req.send_header('Content-Length', str(len(data)))
+    req.send_header('Cache-Control', 'no-cache')
+    if etag:
+      req.send_header('ETag', etag)
+    req.end_headers()
+    req.wfile.write(data)
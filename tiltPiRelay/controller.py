@@ -4,18 +4,17 @@ import os
 import time
 import logging
 import errno
+import threading
 import temp
 import configparser
 import RPi.GPIO as GPIO
 from distutils.util import strtobool
-from queue import SimpleQueue
+from ringq import RingQueue
 #from glob import glob
-from rpi_lcd import LCD
 #from time import sleep,now
-from datetime import datetime, timezone
-import board
+from sample import Sample, Schema
+from i2cbus import LCDProxy, SeesawProxy, DeviceDegraded, shared
 
-from adafruit_seesaw import seesaw, rotaryio, digitalio, neopixel
 
 """
 Temp controller class
@@ -51,6 +50,18 @@ Software controller states:
     SET:  set setpoint
     TILT: set Tilt color
     WIND: set window (0.0 - 5.0)
+
+step() does one pass of the control loop and is run by the scheduler
+(scheduler.py) or the asyncio runtime.  Knob input is polled over I2C
+every EVENT_LOOP_WAIT_MS unless the seesaw INT pin is wired to a GPIO
+(int_gpio).  Then the seesaw raises INT when the button or encoder
+changes, an edge on the GPIO wakes the controller's task and the encoder
+is only read after that.  Otherwise the task sleeps until the next mode
+update (at most INT_WAIT_S).
+
+All the LCD and knob I/O goes through the shared I2C bus arbiter (see
+i2cbus.py) so the controllers and the system display don't collide on
+the bus.
 """
 
 logger = logging.getLogger('tiltpirelay.controller')
@@ -75,6 +86,8 @@ TILTCOLORS = [ 'NONE', 'RED', 'GREEN', 'BLACK', 'PURPLE', \
 IDLE_TIMEOUT = 4
 #TOGGLE_TIME  = 2
 EVENT_LOOP_WAIT_MS = 100
+INT_WAIT_S = 1.0
+BUTTON_PIN = 24
 
 # Control On/Off reported value
 # io.adafruit can't do dual Y axis plot so the on/off values
@@ -85,21 +98,29 @@ CONTROL_OFF_VALUE = 60
 
 class Controller:
   
-  def __init__(self, name, config, heat_gpio, cool_gpio, \
-               tempdev, tiltdev, display_addr, rot_addr):
+  def __init__(self, name, settings, heat_gpio, cool_gpio, \
+               tempdev, tiltdev, display_addr, rot_addr, channel=None,
+               int_gpio=None, i2c=None):
 
     self._name = name
-    self._config = config
+    self._schema = Schema(name, ('setpoint', 'window', 'heat', 'cool'))
+    self._settings = settings
+    # Settings version on the display
+    self._shown = None
     self._state = STATES.index('IDLE')
     self._mode = MODES.index('INVALID')
-    self._goidle = time.time()
+    self._goidle = time.monotonic()
     self._temp = tempdev
     self._tilt = tiltdev
     self._last_disp_temp = None
-    self._last_mode_update = 0
+    self._last_mode_update = float('-inf')
     self._run = True;
     self._display_init = False;
-    self.q = SimpleQueue()
+    self.q = channel.source(name) if channel else RingQueue(name=name)
+    self._int_gpio = None
+    self._input = threading.Event()
+    # Set by the scheduler; called from the knob interrupt
+    self.waker = None
 
 
     # Temp placeholders
@@ -113,77 +134,92 @@ class Controller:
     self._heat_gpio = heat_gpio
     self._cool_gpio = cool_gpio
 
+    i2c = i2c or shared()
     try:
-      self._lcd = LCD(address=display_addr, bus=1, width=16, rows=2)
+      self._lcd = LCDProxy(i2c, display_addr, width=16, rows=2)
       self._lcd.backlight(True)
     except OSError as e:
       logger.warning("LCD [0x{:x}] not available".format(display_addr))
       self._lcd = None
 
     try:
-      rot_led_board = seesaw.Seesaw(board.I2C(), addr=rot_addr)
-      rot_led_board.pin_mode(24, rot_led_board.INPUT_PULLUP)
-      self._button = digitalio.DigitalIO(rot_led_board, 24)
-      self._last_but = not self._button.value
-      self._rot = rotaryio.IncrementalEncoder(rot_led_board)
-      self._last_pos = -self._rot.position # - makes CW increment
-      self._pixel = neopixel.NeoPixel(rot_led_board, 6, 1)
-      self._pixel.brightness = 0.1
+      self._knob = SeesawProxy(i2c, rot_addr, BUTTON_PIN)
+      self._last_but = self._knob.button()
+      self._last_pos = -self._knob.position() # - makes CW increment
+      self._pixel = self._knob
+      self._pixel.brightness(0.1)
       self._pixel.fill(YELLOW)
     except ValueError as e:
-      logger.warning("Rotary/LED [0x{}] not available".format(display_addr))
-      self._button = None
+      logger.warning("Rotary/LED [0x{:x}] not available".format(rot_addr))
+      self._knob = None
       self._last_but = False
-      self._rot = None
       self._last_pos = 0
       self._pixel = None
 
+    self._knob_gen = self._knob.generation if self._knob else 0
+    self._lcd_gen = self._lcd.generation if self._lcd else 0
+
+    if int_gpio is not None and self._knob:
+      try:
+        self._knob.enable_interrupts()
+        # INT is open drain, active low
+        GPIO.setup(int_gpio, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(int_gpio, GPIO.FALLING, callback=self._input_event)
+        self._int_gpio = int_gpio
+        logger.info(f"{self._name}  knob input on interrupt gpio-{int_gpio}")
+      except (OSError, RuntimeError) as e:
+        logger.warning(f"{self._name}  knob interrupt on gpio-{int_gpio} not available ({e}); polling")
+
     self.update_mode()
 
+  def _input_event(self, channel):
+    # Runs on the RPi.GPIO event thread
+    self._input.set()
+    if self.waker:
+      self.waker()
+
+  def _input_pending(self):
+    """ True if the knob needs to be read """
+    if self._int_gpio is None:
+      return True
+    # The level check catches an edge that came before the last read
+    if self._input.is_set() or GPIO.input(self._int_gpio) == GPIO.LOW:
+      self._input.clear()
+      return True
+    return False
+
   def update_mode(self):
     old_mode = self._mode
-    if self._temp.last() is None:
+    s = self._settings.current
+    t = self._temp.last()
+    if t is None:
       self._mode = MODES.index('INVALID')
       GPIO.output(self._heat_gpio, 0)
       GPIO.output(self._cool_gpio, 0)
       logger.debug(f"{self._name}  mode: INVALID;  HEAT gpio-{self._heat_gpio} off; " + \
                    f"COOL gpio-{self._cool_gpio} off")
-      self.q.put({'timestamp': datetime.now(timezone.utc).timestamp(), \
-                  'name': f"{self._name}",               \
-                  'setpoint': float(self._config['setpoint']),
-                  'window': float(self._config['window']),
-                  'heat': CONTROL_OFF_VALUE,
-                  'cool': CONTROL_OFF_VALUE})
+      self.q.put(Sample(self._schema, (s.setpoint, s.window,
+                                       CONTROL_OFF_VALUE, CONTROL_OFF_VALUE)))
       if self._pixel:
           self._pixel.fill(YELLOW)
-    elif self._temp.last() > (float(self._config['setpoint']) + \
-                              float(self._config['window'])):
+    elif t > s.setpoint + s.window:
       self._mode = MODES.index('COOL')
       GPIO.output(self._heat_gpio, 0)
       GPIO.output(self._cool_gpio, 1)
       logger.debug(f"{self._name}  mode: COOL;  HEAT gpio-{self._heat_gpio} off; " + \
                    f"COOL gpio-{self._cool_gpio} on")
-      self.q.put({'timestamp': datetime.now(timezone.utc).timestamp(), \
-                  'name': f"{self._name}",               \
-                  'setpoint': float(self._config['setpoint']),
-                  'window': float(self._config['window']),
-                  'heat': CONTROL_OFF_VALUE,
-                  'cool': CONTROL_ON_VALUE})
+      self.q.put(Sample(self._schema, (s.setpoint, s.window,
+                                       CONTROL_OFF_VALUE, CONTROL_ON_VALUE)))
       if self._pixel:
           self._pixel.fill(BLUE)
-    elif self._temp.last() < (float(self._config['setpoint']) - \
-                              float(self._config['window'])):
+    elif t < s.setpoint - s.window:
       self._mode = MODES.index('HEAT')
       GPIO.output(self._cool_gpio, 0)
       GPIO.output(self._heat_gpio, 1)
       logger.debug(f"{self._name}  mode: HEAT;  HEAT gpio-{self._heat_gpio} on; " + \
                    f"COOL gpio-{self._cool_gpio} off")
-      self.q.put({'timestamp': datetime.now(timezone.utc).timestamp(), \
-                  'name': f"{self._name}",               \
-                  'setpoint': float(self._config['setpoint']),
-                  'window': float(self._config['window']),
-                  'heat': CONTROL_ON_VALUE,
-                  'cool': CONTROL_OFF_VALUE})
+      self.q.put(Sample(self._schema, (s.setpoint, s.window,
+                                       CONTROL_ON_VALUE, CONTROL_OFF_VALUE)))
       if self._pixel:
           self._pixel.fill(RED)
     else:
@@ -192,12 +228,8 @@ class Controller:
       GPIO.output(self._cool_gpio, 0)
       logger.debug(f"{self._name}  mode: OFF;  HEAT gpio-{self._heat_gpio} off; " + \
                    f"COOL gpio-{self._cool_gpio} off")
-      self.q.put({'timestamp': datetime.now(timezone.utc).timestamp(), \
-                  'name': f"{self._name}",               \
-                  'setpoint': float(self._config['setpoint']),
-                  'window': float(self._config['window']),
-                  'heat': CONTROL_OFF_VALUE,
-                  'cool': CONTROL_OFF_VALUE})
+      self.q.put(Sample(self._schema, (s.setpoint, s.window,
+                                       CONTROL_OFF_VALUE, CONTROL_OFF_VALUE)))
       if self._pixel:
           self._pixel.fill(BLACK)
 
@@ -206,6 +238,8 @@ class Controller:
 
   def update_display(self):
     lines = ['']*2
+    s = self._settings.current
+    self._shown = s.version
 
     if MODES[self._mode] == 'INVALID':
       lines[0] = "ERROR: MISSING"
@@ -217,9 +251,9 @@ class Controller:
       if t is None:
         temp='missing'
       else:
-        temp = "{:.1f}/{:.1f}".format(t, float(self._config['setpoint']))
+        temp = "{:.1f}/{:.1f}".format(t, s.setpoint)
       lines[0] = "{:12s}{:4s}".format(temp, MODES[self._mode])
-      if self._config['tiltcolor'] != 'NONE' and \
+      if s.tiltcolor != 'NONE' and \
          self._tilt_temp != None and \
          self._tilt_sg != None:
         tilt_temp = "{:.1f}".format(self._tilt_temp)
@@ -232,15 +266,15 @@ class Controller:
   
     elif STATES[self._state] == 'SET':
       lines[0] = "Set Setpoint:"
-      lines[1] = "  {:.1f} F".format(float(self._config['setpoint']))
+      lines[1] = "  {:.1f} F".format(s.setpoint)
 
     elif STATES[self._state] == 'TILT':
       lines[0] = "Set Tilt Color:"
-      lines[1] = "  {}".format(self._config['tiltcolor'])
+      lines[1] = "  {}".format(s.tiltcolor)
 
     elif STATES[self._state] == 'WIND':
       lines[0] = "Set Window:"
-      lines[1] = "  {:.1f} F".format(float(self._config['window']))
+      lines[1] = "  {:.1f} F".format(s.window)
 
     else:
       logger.error("Display update unknown state: {}".format(self._state))
@@ -253,123 +287,152 @@ class Controller:
       self._lcd.text(lines[1], 2)
 
   def is_idle(self):
-    return (time.time() > self._goidle)
-
-  def control_thread(self):
-    while self._run:
-      begin_time = time.time()
-      uichange = False
-      display_update = False
-
-      # Run updates at the same interval that temp is being queried
-      if (begin_time - self._last_mode_update) > self._temp.get_interval():
-        self._last_mode_update = begin_time
-        uichange = self.update_mode()
-
-      if self._button:
-        # I2C access fails sometimes; ignore those
-        try:
-            but = not self._button.value
-        except OSError as e:
-            logger.error("Button read failure: {}".format(e))
-            continue
-      else:
-        but = self._last_but
-
-      if self._rot:
-        try:
-            pos = -self._rot.position #negative makes CW go up
-        except OSError as e:
-            logger.error("Rotary read failure: {}".format(e))
-            continue
-      else:
-        pos = self._last_pos
-
-      # Handle button press
-      if not self._last_but and but:
-        self._state = (self._state + 1) % len(STATES)
-        logger.debug("Button press; new state: {}".format(STATES[self._state]))
+    return (time.monotonic() > self._goidle)
+
+  def step(self):
+    """
+    One pass of the control loop: mode update, knob input and display.
+    Returns the seconds until the next pass is needed.
+    """
+    begin_time = time.monotonic()
+    uichange = False
+    display_update = False
+
+    # Run updates at the same interval that temp is being queried
+    if (begin_time - self._last_mode_update) > self._temp.period:
+      self._last_mode_update = begin_time
+      uichange = self.update_mode()
+
+    pending = self._input_pending()
+    but = self._last_but
+    pos = self._last_pos
+
+    if self._knob and pending:
+      # I2C access fails sometimes; keep the last input and carry on.  A
+      # failing board is degraded by the bus arbiter and retried in the
+      # background; until then the controller runs display only.
+      try:
+          if self._knob.generation != self._knob_gen:
+            # Board was reset; its encoder restarted from 0
+            self._knob_gen = self._knob.generation
+            self._last_but = but = self._knob.button()
+            self._last_pos = pos = -self._knob.position()
+          but = self._knob.button()
+          if self._int_gpio is not None:
+            # Clears INT for the button
+            self._knob.clear_interrupt()
+          pos = -self._knob.position() #negative makes CW go up
+      except DeviceDegraded:
+          if self._state != STATES.index('IDLE'):
+            self._state = STATES.index('IDLE')
+            display_update = True
+      except OSError as e:
+          logger.error("Knob read failure: {}".format(e))
+
+    if self._lcd and self._lcd.generation != self._lcd_gen:
+      # Display was reinitialised (cleared)
+      self._lcd_gen = self._lcd.generation
+      display_update = True
+
+    # Handle button press
+    if not self._last_but and but:
+      self._state = (self._state + 1) % len(STATES)
+      logger.debug("Button press; new state: {}".format(STATES[self._state]))
+      uichange = True
+
+    # Handle rotation
+    # TODO: maybe add some acceleration scaling
+    elif self._last_pos != pos:
+      logger.debug("Rotation: {}".format(pos - self._last_pos))
+      s = self._settings.current
+      if STATES[self._state] == 'SET':
+        s = self._settings.update(setpoint=s.setpoint + (pos - self._last_pos) / 10.0)
         uichange = True
-
-      # Handle rotation
-      # TODO: maybe add some acceleration scaling
-      elif self._last_pos != pos:
-        logger.debug("Rotation: {}".format(pos - self._last_pos))
-        if STATES[self._state] == 'SET':
-          self._config['setpoint'] = str(float(self._config['setpoint']) + \
-                                         (pos - self._last_pos) / 10.0)
-          self._config['updated'] = 'True'
-          uichange = True
-          logger.info("New setpoint: {}".format(self._config['setpoint']))
-        elif STATES[self._state] == 'TILT':
-          new_i = (TILTCOLORS.index(self._config['tiltcolor']) + \
-                   (pos - self._last_pos)) % len(TILTCOLORS)
-          self._config['tiltcolor'] = TILTCOLORS[new_i]
-          self._config['updated'] = 'True'
+        logger.info("New setpoint: {}".format(s.setpoint))
+      elif STATES[self._state] == 'TILT':
+        new_i = (TILTCOLORS.index(s.tiltcolor) + \
+                 (pos - self._last_pos)) % len(TILTCOLORS)
+        s = self._settings.update(tiltcolor=TILTCOLORS[new_i])
+        uichange = True
+        logger.info("New Tilt Color: {}".format(s.tiltcolor))
+      elif STATES[self._state] == 'WIND':
+        new_w = s.window + (pos - self._last_pos)/10.0
+        new_w = max(WINMIN, min(WINMAX, new_w))
+        if new_w != s.window:
+          s = self._settings.update(window=new_w)
           uichange = True
-          logger.info("New Tilt Color: {}".format(self._config['tiltcolor']))
-        elif STATES[self._state] == 'WIND':
-          new_w = float(self._config['window']) + (pos - self._last_pos)/10.0
-          new_w = max(WINMIN, min(WINMAX, new_w))
-          if new_w != float(self._config['window']):
-            self._config['window'] = str(new_w)
-            self._config['updated'] = 'True'
-            uichange = True
-            logger.info("New Window: {}".format(self._config['window']))
-  
-      # return True if display has never been initalized
-      if (not self._display_init):
-        logger.debug("First pass; force display update")
-        self._display_init = True
-        display_update = True
-
-      # UI change resets idle timeout
-      if uichange:
-        self._goidle = time.time() + IDLE_TIMEOUT
-        display_update = True
-
-      # Check for temp change in IDLE
-      if (self._state == STATES.index('IDLE')) and \
-         (self._last_disp_temp != self._temp.last()):
-        logger.debug("Temp Change (ctrl-{}): {} -> {}".format(self._temp._bus, self._last_disp_temp, self._temp.last()))
+          logger.info("New Window: {}".format(s.window))
+
+    # Settings changed elsewhere
+    if self._shown is not None and self._settings.current.version != self._shown:
+      display_update = True
+
+    # return True if display has never been initalized
+    if (not self._display_init):
+      logger.debug("First pass; force display update")
+      self._display_init = True
+      display_update = True
+
+    # UI change resets idle timeout
+    if uichange:
+      self._goidle = time.monotonic() + IDLE_TIMEOUT
+      display_update = True
+
+    # Check for temp change in IDLE
+    if (self._state == STATES.index('IDLE')) and \
+       (self._last_disp_temp != self._temp.last()):
+      logger.debug("Temp Change (ctrl-{}): {} -> {}".format(self._temp._bus, self._last_disp_temp, self._temp.last()))
+      display_update = True
+
+    self._last_but = but
+    self._last_pos = pos
+
+    # Lower Priority Work
+    if (time.monotonic() - begin_time) < (EVENT_LOOP_WAIT_MS / 2000.0):
+      # Update Tilt data
+      color = self._settings.current.tiltcolor
+      if color != 'NONE' and \
+         self._tilt is not None:
+        last = self._tilt.get_last(color)
+        # TODO: check timestamp to see if it's recent enough
+        if last is not None:
+          self._tilt_temp = last['temp']
+          self._tilt_sg = last['sg']
+
+      # Check for idle timeout
+      if self.is_idle() and self._state != STATES.index('IDLE'):
+        logger.debug("Idle timeout")
+        self._state = STATES.index('IDLE')
         display_update = True
 
-      self._last_but = but
-      self._last_pos = pos
 
-      # Lower Priority Work
-      if (time.time() - begin_time) < (EVENT_LOOP_WAIT_MS / 2000.0):
-        # Update Tilt data
-        if self._config['tiltcolor'] != 'NONE' and \
-           self._tilt is not None:
-          last = self._tilt.get_last(self._config['tiltcolor'])
-          # TODO: check timestamp to see if it's recent enough
-          if last is not None:
-            self._tilt_temp = last['temp']
-            self._tilt_sg = last['sg']
+    if display_update:
+      self.update_display()
 
-        # Check for idle timeout
-        if self.is_idle() and self._state != STATES.index('IDLE'):
-          logger.debug("Idle timeout")
-          self._state = STATES.index('IDLE')
-          display_update = True
+    if self._int_gpio is None:
+      # Polled input
+      return max(0.0, EVENT_LOOP_WAIT_MS / 1000.0 - (time.monotonic() - begin_time))
+    # Nothing to do until the knob moves or the next mode update is due
+    wait = self._last_mode_update + self._temp.period - time.monotonic()
+    if self._state != STATES.index('IDLE'):
+      wait = min(wait, self._goidle - time.monotonic())
+    return max(0.0, min(INT_WAIT_S, wait))
 
-
-      while (time.time() - begin_time) < (EVENT_LOOP_WAIT_MS / 1000.0):
-        time.sleep(0.01)
-
-      if display_update:
-        self.update_display()
-
-    # Shutdown cleanup
+  def shutdown(self):
+    """ Relays off and show the controller is off """
+    if self._int_gpio is not None:
+      GPIO.remove_event_detect(self._int_gpio)
     GPIO.output(self._heat_gpio, 0)
     GPIO.output(self._cool_gpio, 0)
-    self._pixel.fill(YELLOW)
+    if self._pixel:
+      self._pixel.fill(YELLOW)
     logger.info(f"{self._name}  Shutdown: HEAT gpio-{self._heat_gpio} off; " + \
                 f"COOL gpio-{self._cool_gpio} off")
     if self._lcd:
       self._lcd.text("SYSTEM", 1, align='center')
       self._lcd.text("OFF", 2, align='center')
+      self._lcd.flush()
 
   def end(self):
     self._run = False
+    self._input.set()
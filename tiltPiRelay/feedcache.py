@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import time
+import logging
+import requests
+import threading
+from Adafruit_IO import Feed, Group, errors
+
+"""
+Feed catalog class
+
+Cache of the io.adafruit.com feed names and keys in the upload group.
+The catalog is saved to a file next to the config file and loaded at
+boot, so uploads can start immediately (and keep working) even when the
+network isn't up yet.
+
+A background thread refreshes the catalog from io.adafruit.com (creating
+the group if it doesn't exist) and creates feeds which the uploader asked
+for but which don't exist yet.  Missing feeds are collected and created
+together in one pass of up to CREATE_BATCH feeds rather than one at a
+time in the upload path.  Failed refreshes are retried with an
+exponential backoff.  A feed io.adafruit.com refuses to create (a 4xx
+such as an exhausted feed quota) is reported by failed() and the others
+are still created.
+
+"""
+
+logger = logging.getLogger('tiltpirelay.feedcache')
+
+DEFAULT_REFRESH_S = 3600
+CREATE_BATCH = 10
+RETRY_MIN_S = 5
+RETRY_MAX_S = 300
+
+def permanent(e):
+  """ The status of a RequestError which retrying won't fix (4xx), or None """
+  # Status code is only in the message
+  m = re.search(r'failed: (\d{3})', str(e))
+  if m and 400 <= int(m.group(1)) < 500 and int(m.group(1)) not in (408, 429):
+    return int(m.group(1))
+  return None
+
+class FeedCatalog:
+
+  def __init__(self, aio, group, path, refresh=DEFAULT_REFRESH_S):
+    self._aio = aio
+    self._group = group
+    self._path = path
+    self._refresh = refresh
+    self._lock = threading.Lock()
+    self._wake = threading.Event()
+    self._keys = {}       # feed name -> feed key
+    self._missing = set() # feed names waiting to be created
+    self._failed = {}     # feed name -> status of a refused creation
+    self._run = True
+    self._thread = None
+    self.load()
+
+  def load(self):
+    try:
+      with open(self._path) as f:
+        cache = json.load(f)
+    except (OSError, ValueError) as e:
+      logger.info(f"No feed cache loaded from {self._path} ({e})")
+      return
+    if cache.get('group') == self._group:
+      with self._lock:
+        self._keys.update(cache.get('feeds', {}))
+      logger.info(f"Loaded {len(self._keys)} feeds from {self._path}")
+
+  def save(self):
+    with self._lock:
+      cache = { 'group': self._group, 'feeds': dict(self._keys) }
+    tmp = self._path + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1)
+      os.replace(tmp, self._path)
+    except OSError as e:
+      logger.error(f"Failed to save feed cache {self._path}: {e}")
+
+  def key(self, name):
+    """ Return the key of a feed, or None if it isn't known (yet) """
+    with self._lock:
+      return self._keys.get(name)
+
+  def failed(self, name):
+    """ Status of the last attempt to create a feed if it was refused, else None """
+    with self._lock:
+      return self._failed.get(name)
+
+  def want(self, name):
+    """ Ask for a feed to be created in the background """
+    with self._lock:
+      if name in self._keys or name in self._missing:
+        return
+      self._missing.add(name)
+    self._wake.set()
+
+  def start(self):
+    self._thread = threading.Thread(target=self.refresh_thread, daemon=True)
+    self._thread.start()
+
+  def end(self):
+    self._run = False
+    self._wake.set()
+
+  def refresh_thread(self):
+    delay = 0
+    next_refresh = 0
+    while self._run:
+      self._wake.wait(max(0, next_refresh - time.time()))
+      self._wake.clear()
+      if not self._run:
+        break
+      if time.time() < next_refresh and not self._missing:
+        continue
+      if self.refresh():
+        delay = 0
+        next_refresh = time.time() + self._refresh
+      else:
+        delay = min(RETRY_MAX_S, max(RETRY_MIN_S, delay * 2))
+        next_refresh = time.time() + delay
+        logger.info(f"Retry feed refresh in {delay} seconds")
+
+  def refresh(self):
+    """ Reload the group's feeds and create missing ones; returns True on success """
+    try:
+      try:
+        g = self._aio.groups(self._group)
+      except errors.RequestError:
+        logger.warning(f"Creating AIO group: {self._group}")
+        g = self._aio.create_group(Group(name=self._group))
+      keys = { f.name: f.key for f in g.feeds }
+      with self._lock:
+        self._keys.update(keys)
+        self._missing -= set(self._keys)
+        create = sorted(self._missing)[:CREATE_BATCH]
+
+      for name in create:
+        logger.warning(f"  Creating new feed: {name}")
+        try:
+          feed = self._aio.create_feed(Feed(name=name), group_key=self._group)
+        except errors.RequestError as e:
+          status = permanent(e)
+          if status is None:
+            raise
+          logger.error(f"  Can't create feed {name} ({e})")
+          # Tried again when the uploader next asks for it
+          with self._lock:
+            self._failed[name] = status
+            self._missing.discard(name)
+          continue
+        with self._lock:
+          self._keys[name] = feed.key
+          self._missing.discard(name)
+          self._failed.pop(name, None)
+    except errors.ThrottlingError:
+      logger.error("  Got throttled refreshing AIO feeds")
+      return False
+    except errors.RequestError as e:
+      logger.error(f"  Failed to refresh AIO feeds ({e})")
+      return False
+    except requests.exceptions.ConnectionError:
+      logger.error("  Failed to refresh AIO feeds (connection error)")
+      return False
+    except requests.exceptions.ReadTimeout:
+      logger.error("  Failed to refresh AIO feeds (timeout)")
+      return False
+    finally:
+      self.save()
+
+    # More feeds than one batch can create; go again
+    if self._missing:
+      self._wake.set()
+    logger.info(f"AIO feed catalog refreshed: {len(self._keys)} feeds")
+    return True
@@ -0,0 +1,137 @@
+import logging
+from bisect import insort, bisect_left
+from collections import deque
+
+"""
+Reading filter classes
+
+Incremental filter chain run on every temp probe reading before it is
+used by the controllers or reported, so a single bad read (the 85C a
+DS18B20 returns before its first conversion, a glitch on the bus) can't
+flip the relays.  Each stage takes one value at a time and returns the
+filtered value, or None to drop the reading; work per reading doesn't
+depend on how many readings have been seen.
+
+  reject[:step]   drop impossible values (the power-on value and anything
+                  outside the DS18B20 range) and jumps of more than step
+                  F (default 10) from the last accepted value.  A jump
+                  which persists for 3 readings is accepted as real.
+  median[:size]   rolling median of the last size readings (default 5)
+  ema[:alpha]     exponential moving average (default 0.5)
+
+A chain is described by a comma separated list of stages, e.g.
+'reject,median:5,ema:0.3'.  Each stage counts the readings it has seen
+and dropped; see FilterChain.stats().
+
+"""
+
+logger = logging.getLogger('tiltpirelay.filters')
+
+DEFAULT_CHAIN = 'reject,median:3,ema:0.5'
+
+# DS18B20 reads 85C until its first conversion completes
+POWER_ON_F = 185.0
+MIN_F = -67.0    # -55C
+MAX_F = 257.0    # 125C
+
+class Stage:
+  name = None
+
+  def __init__(self):
+    self.seen = 0
+    self.rejected = 0
+
+  def __call__(self, value):
+    self.seen += 1
+    out = self.process(value)
+    if out is None:
+      self.rejected += 1
+    return out
+
+  def process(self, value):
+    raise NotImplementedError
+
+  def stats(self):
+    return { 'stage': self.name, 'seen': self.seen, 'rejected': self.rejected }
+
+class Reject(Stage):
+  name = 'reject'
+  PERSIST = 3
+
+  def __init__(self, step=10.0):
+    super().__init__()
+    self._step = float(step)
+    self._last = None
+    self._jumps = 0
+
+  def process(self, value):
+    if value == POWER_ON_F or not (MIN_F <= value <= MAX_F):
+      return None
+    if self._last is not None and abs(value - self._last) > self._step:
+      self._jumps += 1
+      if self._jumps < self.PERSIST:
+        return None
+    self._jumps = 0
+    self._last = value
+    return value
+
+class Median(Stage):
+  name = 'median'
+
+  def __init__(self, size=5):
+    super().__init__()
+    self._window = deque(maxlen=max(1, int(size)))
+    self._sorted = []
+
+  def process(self, value):
+    if len(self._window) == self._window.maxlen:
+      del self._sorted[bisect_left(self._sorted, self._window[0])]
+    self._window.append(value)
+    insort(self._sorted, value)
+    n = len(self._sorted)
+    if n % 2:
+      return self._sorted[n // 2]
+    return (self._sorted[n // 2 - 1] + self._sorted[n // 2]) / 2
+
+class EMA(Stage):
+  name = 'ema'
+
+  def __init__(self, alpha=0.5):
+    super().__init__()
+    self._alpha = float(alpha)
+    if not 0 < self._alpha <= 1:
+      raise ValueError(f"EMA alpha must be in (0, 1], not {alpha}")
+    self._value = None
+
+  def process(self, value):
+    if self._value is None:
+      self._value = value
+    else:
+      self._value += self._alpha * (value - self._value)
+    return self._value
+
+STAGES = { s.name: s for s in (Reject, Median, EMA) }
+
+class FilterChain:
+
+  def __init__(self, spec=DEFAULT_CHAIN, name=None):
+    self.name = name
+    self._stages = []
+    for item in filter(None, (i.strip() for i in spec.split(','))):
+      (stage, _, arg) = item.partition(':')
+      if stage not in STAGES:
+        raise ValueError(f"Unknown filter stage: {stage}")
+      self._stages.append(STAGES[stage](arg) if arg else STAGES[stage]())
+
+  def __call__(self, value):
+    """ Filtered value, or None if the reading was dropped """
+    for stage in self._stages:
+      value = stage(value)
+      if value is None:
+        if stage.rejected == 1 or (stage.rejected % 100) == 0:
+          logger.warning(f"Filter {stage.name} on {self.name} dropped {stage.rejected} readings")
+        return None
+    return value
+
+  def stats(self):
+    return [s.stats() for s in self._stages]
@@ -0,0 +1,439 @@
+import time
+import heapq
+import logging
+import threading
+from itertools import count
+from collections import deque
+
+"""
+I2C bus arbiter
+
+The three LCDs and the two seesaw knob boards share I2C bus 1 and are
+driven from several threads (both controllers and the system display).
+I2CBus owns the bus: every transaction is queued to a single worker
+thread which runs them one at a time, so an LCD write from one thread
+can't be interleaved with a knob read from another.
+
+Transactions are run by priority (knob input first, then the knob LEDs,
+then the displays) and in order within a priority.  A queued transaction
+can be given a key; queueing another one for the same device and key
+replaces the one still waiting (e.g. only the newest text for an LCD line
+is written).  Reads are synchronous (call) and raise the device's error
+to the caller; writes can be queued without waiting (post) in which case
+errors are only counted and logged.  Per device transaction, error and
+coalesce counts and latency (queued to done) are available from stats().
+
+A device that fails FAULT_THRESHOLD transactions in a row is marked
+degraded (the circuit breaker opens): its transactions then fail straight
+away with DeviceDegraded without touching the bus, and the bus thread
+retries the device in the background after a backoff which doubles on
+every failed retry (BACKOFF_MIN_S up to BACKOFF_MAX_S).  A device can
+register a probe (e.g. re-initialising it) to use for the retry; without
+one the next transaction after the backoff is let through as the retry.
+Fault and recovery counts are part of stats(), as are the counters of
+the device's proxy if it registered them (e.g. the LCD bytes/s).
+
+LCDProxy and SeesawProxy wrap rpi_lcd.LCD and the seesaw knob board so
+all their I/O goes through the arbiter.  LCDProxy only writes the
+characters that changed since the last update.
+
+"""
+
+logger = logging.getLogger('tiltpirelay.i2cbus')
+
+PRIO_INPUT = 0
+PRIO_LED = 1
+PRIO_DISPLAY = 2
+
+FAULT_THRESHOLD = 3
+BACKOFF_MIN_S = 1.0
+BACKOFF_MAX_S = 60.0
+
+# HD44780 DDRAM address of the start of each row
+ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+ALIGN = { 'left': 'ljust', 'right': 'rjust', 'center': 'center' }
+# rpi_lcd sends each command/character as two nibbles of 3 bytes each
+LCD_WRITE_BYTES = 6
+LCD_INIT_WRITES = 6
+RATE_WINDOW_S = 60.0
+
+class DeviceDegraded(OSError):
+  """ The device has been failing; not tried until its backoff expires """
+  pass
+
+class Transaction:
+  __slots__ = ('device', 'fn', 'key', 'queued', 'done', 'result', 'error')
+
+  def __init__(self, device, fn, key):
+    self.device = device
+    self.fn = fn
+    self.key = key
+    self.queued = time.monotonic()
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+  def wait(self, timeout=None):
+    if not self.done.wait(timeout):
+      raise OSError(f"I2C transaction on {self.device} timed out")
+    if self.error:
+      raise self.error
+    return self.result
+
+class DeviceStats:
+  __slots__ = ('ops', 'errors', 'coalesced', 'latency_last', 'latency_max', 'latency_total',
+               'failures', 'degraded', 'backoff', 'retry_at', 'faults', 'recoveries',
+               'skipped', 'probe', 'report')
+
+  def __init__(self):
+    self.ops = 0
+    self.errors = 0
+    self.coalesced = 0
+    self.latency_last = 0.0
+    self.latency_max = 0.0
+    self.latency_total = 0.0
+    self.failures = 0     # in a row
+    self.degraded = False
+    self.backoff = 0.0
+    self.retry_at = 0.0
+    self.faults = 0
+    self.recoveries = 0
+    self.skipped = 0
+    self.probe = None
+    self.report = None
+
+class I2CBus:
+
+  def __init__(self, bus=1):
+    self.bus = bus
+    self._cond = threading.Condition()
+    self._queue = []      # (priority, seq, Transaction)
+    self._pending = {}    # (device, key) -> Transaction
+    self._seq = count()
+    self._stats = {}
+    self._run = True
+
+  def register(self, device, probe=None, report=None):
+    """
+    Set the function used to retry the device once it is degraded, and
+    one which returns the device's own counters for stats()
+    """
+    with self._cond:
+      stats = self._stats.setdefault(device, DeviceStats())
+      stats.probe = probe
+      stats.report = report
+
+  def degraded(self, device):
+    with self._cond:
+      return device in self._stats and self._stats[device].degraded
+
+  def post(self, device, fn, priority=PRIO_DISPLAY, key=None):
+    """ Queue fn() for the device; returns the Transaction """
+    with self._cond:
+      stats = self._stats.setdefault(device, DeviceStats())
+      if not self._run:
+        return self._failed(device, fn, key, OSError(f"I2C bus {self.bus} closed"))
+      if stats.degraded and (stats.probe or time.monotonic() < stats.retry_at):
+        stats.skipped += 1
+        return self._failed(device, fn, key, DeviceDegraded(f"I2C {device} degraded"))
+      if key is not None:
+        txn = self._pending.get((device, key))
+        if txn is not None:
+          # Not run yet; the new one replaces it in its queue slot
+          txn.fn = fn
+          stats.coalesced += 1
+          return txn
+      txn = Transaction(device, fn, key)
+      if key is not None:
+        self._pending[(device, key)] = txn
+      heapq.heappush(self._queue, (priority, next(self._seq), txn))
+      self._cond.notify()
+      return txn
+
+  @staticmethod
+  def _failed(device, fn, key, error):
+    """ Transaction which is never run """
+    txn = Transaction(device, fn, key)
+    txn.error = error
+    txn.done.set()
+    return txn
+
+  def call(self, device, fn, priority=PRIO_INPUT, timeout=None):
+    """ Run fn() on the bus and return its result (or raise its error) """
+    return self.post(device, fn, priority).wait(timeout)
+
+  def bus_thread(self):
+    logger.debug(f"Begin I2C bus {self.bus} thread")
+    while True:
+      with self._cond:
+        self._cond.wait_for(lambda: self._queue or not self._run, self._next_retry())
+        if not self._queue:
+          if not self._run:
+            break
+          # Idle; retry the degraded devices which are due
+          due = [(d, s.probe) for (d, s) in self._stats.items()
+                 if s.degraded and s.probe and s.retry_at <= time.monotonic()]
+        else:
+          due = None
+          (_, _, txn) = heapq.heappop(self._queue)
+          if txn.key is not None:
+            del self._pending[(txn.device, txn.key)]
+          stats = self._stats[txn.device]
+
+      if due is not None:
+        for (device, probe) in due:
+          try:
+            probe()
+            self._result(device, None)
+          except Exception as e:
+            self._result(device, e)
+        continue
+
+      try:
+        txn.result = txn.fn()
+      except Exception as e:
+        txn.error = e
+      latency = time.monotonic() - txn.queued
+      txn.done.set()
+
+      with self._cond:
+        stats.ops += 1
+        stats.latency_last = latency
+        stats.latency_max = max(stats.latency_max, latency)
+        stats.latency_total += latency
+      self._result(txn.device, txn.error)
+
+  def _next_retry(self):
+    """ Seconds until the next degraded device is due a retry (None if none) """
+    due = [s.retry_at for s in self._stats.values() if s.degraded and s.probe]
+    return max(0.0, min(due) - time.monotonic()) if due else None
+
+  def _result(self, device, error):
+    """ Update the circuit breaker of the device with a transaction result """
+    with self._cond:
+      stats = self._stats[device]
+      if error is None:
+        stats.failures = 0
+        if stats.degraded:
+          stats.degraded = False
+          stats.recoveries += 1
+          logger.info(f"I2C {device} recovered")
+        return
+
+      stats.errors += 1
+      stats.failures += 1
+      if stats.degraded:
+        # Failed retry
+        stats.backoff = min(BACKOFF_MAX_S, stats.backoff * 2)
+        stats.retry_at = time.monotonic() + stats.backoff
+        logger.debug(f"I2C {device} still failing ({error}); retry in {stats.backoff:.1f}s")
+      elif stats.failures >= FAULT_THRESHOLD:
+        stats.degraded = True
+        stats.faults += 1
+        stats.backoff = BACKOFF_MIN_S
+        stats.retry_at = time.monotonic() + stats.backoff
+        logger.warning(f"I2C {device} degraded after {stats.failures} errors; last: {error}")
+      elif stats.errors == 1 or (stats.errors % 100) == 0:
+        logger.warning(f"I2C {device}: {stats.errors} errors; last: {error}")
+
+  def stats(self):
+    with self._cond:
+      reports = { device: s.report for (device, s) in self._stats.items() if s.report }
+      stats = { device: { 'ops': s.ops,
+                          'errors': s.errors,
+                          'coalesced': s.coalesced,
+                          'latency': s.latency_last,
+                          'latency_max': s.latency_max,
+                          'latency_mean': s.latency_total / s.ops if s.ops else 0.0,
+                          'degraded': s.degraded,
+                          'faults': s.faults,
+                          'recoveries': s.recoveries,
+                          'skipped': s.skipped }
+                for (device, s) in self._stats.items() }
+    # The proxies' own counters; not read under the bus lock
+    for (device, report) in reports.items():
+      stats[device]['proxy'] = report()
+    return stats
+
+  def end(self):
+    """ Stop once everything already queued has run """
+    with self._cond:
+      self._run = False
+      self._cond.notify()
+
+_shared = None
+
+def shared():
+  """ Arbiter for I2C bus 1 shared by all the displays and knobs """
+  global _shared
+  if _shared is None:
+    _shared = I2CBus(1)
+    threading.Thread(target=_shared.bus_thread, daemon=True).start()
+  return _shared
+
+class LCDProxy:
+  """
+  rpi_lcd.LCD with its I/O run by the arbiter
+
+  Keeps a shadow copy of what is on the display.  text() for a line that
+  hasn't changed does nothing; otherwise only the runs of characters that
+  differ are written, each after a cursor move.  Every HD44780 command or
+  character is LCD_WRITE_BYTES bytes over the I2C backpack, which is what
+  bytes/bytes_per_s in stats() count.
+  """
+
+  def __init__(self, i2c, address, width=16, rows=2):
+    from rpi_lcd import LCD
+    self._i2c = i2c
+    self.device = f"lcd-0x{address:02x}"
+    self._width = width
+    self._rows = rows
+    # Bumped every time the display is (re)initialised and has lost its contents
+    self.generation = 0
+    self._shadow = None   # what the display shows; only touched on the bus thread
+    self._wanted = None   # newest text asked for, per line
+    self.frames = 0
+    self.skipped = 0
+    self.bytes = 0
+    self._recent = deque()   # (time, bytes) over the last RATE_WINDOW_S
+
+    def setup():
+      self._lcd = LCD(address=address, bus=i2c.bus, width=width, rows=rows)
+      # Initialising clears the display
+      self._shadow = [' ' * width for _ in range(rows)]
+      self._wanted = [None] * rows
+      self._count(LCD_INIT_WRITES)
+      self.generation += 1
+    i2c.call(self.device, setup, PRIO_DISPLAY)
+    # Recovering a display means initialising it again
+    i2c.register(self.device, setup, self.stats)
+
+  def degraded(self):
+    return self._i2c.degraded(self.device)
+
+  def text(self, text, line, align='left'):
+    text = getattr(text[:self._width], ALIGN.get(align, 'ljust'))(self._width)
+    row = line - 1
+    if self._wanted[row] == text:
+      self.skipped += 1
+      return
+    self._wanted[row] = text
+    # Only the newest text for a line needs writing
+    self._i2c.post(self.device, lambda: self._draw(row, text),
+                   PRIO_DISPLAY, ('text', line))
+
+  def _draw(self, row, text):
+    """ Write the characters of the row which differ from the shadow """
+    try:
+      self._draw_runs(row, text)
+    except Exception:
+      # Make sure the next text() for this row is written
+      self._wanted[row] = None
+      raise
+
+  def _draw_runs(self, row, text):
+    old = self._shadow[row]
+    writes = 0
+    col = 0
+    while col < self._width:
+      if text[col] == old[col]:
+        col += 1
+        continue
+      # Run of changes; gaps of one unchanged character are cheaper to
+      # write through than to move the cursor over
+      end = col + 1
+      while end < self._width and (text[end] != old[end] or
+                                   (end + 1 < self._width and text[end + 1] != old[end + 1])):
+        end += 1
+      self._lcd.write(0x80 | (ROW_OFFSETS[row] + col))
+      for c in text[col:end]:
+        self._lcd.write(ord(c), mode=1)
+      writes += 1 + end - col
+      self._shadow[row] = self._shadow[row][:col] + text[col:end] + self._shadow[row][end:]
+      col = end
+    self.frames += 1
+    self._count(writes)
+
+  def _count(self, writes):
+    now = time.monotonic()
+    n = writes * LCD_WRITE_BYTES
+    self.bytes += n
+    self._recent.append((now, n))
+    while self._recent and self._recent[0][0] < now - RATE_WINDOW_S:
+      self._recent.popleft()
+
+  def backlight(self, turn_on=True):
+    def write():
+      self._lcd.backlight(turn_on)
+      self._count(1)
+    self._i2c.post(self.device, write, PRIO_DISPLAY, 'backlight')
+
+  def flush(self, timeout=None):
+    """ Wait for the writes queued so far """
+    self._i2c.call(self.device, lambda: None, PRIO_DISPLAY, timeout)
+
+  def stats(self):
+    return { 'frames': self.frames,
+             'skipped': self.skipped,
+             'bytes': self.bytes,
+             'bytes_per_s': sum(n for (_, n) in list(self._recent)) / RATE_WINDOW_S }
+
+class SeesawProxy:
+  """ Seesaw knob board (button, encoder and NeoPixel) behind the arbiter """
+
+  def __init__(self, i2c, address, button_pin):
+    import board
+    from adafruit_seesaw import seesaw, rotaryio, digitalio, neopixel
+    self._i2c = i2c
+    self.device = f"seesaw-0x{address:02x}"
+    self._button_pin = button_pin
+
+    self._interrupts = False
+    self._brightness = None
+    # Bumped every time the board is (re)initialised; its encoder restarts at 0
+    self.generation = 0
+
+    def setup():
+      ss = seesaw.Seesaw(board.I2C(), addr=address)
+      ss.pin_mode(button_pin, ss.INPUT_PULLUP)
+      (self._ss, self._button, self._rot, self._pixel) = \
+        (ss, digitalio.DigitalIO(ss, button_pin),
+         rotaryio.IncrementalEncoder(ss), neopixel.NeoPixel(ss, 6, 1))
+      if self._brightness is not None:
+        self._pixel.brightness = self._brightness
+      if self._interrupts:
+        self._enable()
+      self.generation += 1
+    i2c.call(self.device, setup)
+    # Recovering the board means resetting and setting it up again
+    i2c.register(self.device, setup)
+
+  def degraded(self):
+    return self._i2c.degraded(self.device)
+
+  def button(self):
+    """ True while the button is pressed """
+    return self._i2c.call(self.device, lambda: not self._button.value)
+
+  def position(self):
+    return self._i2c.call(self.device, lambda: self._rot.position)
+
+  def fill(self, color):
+    self._i2c.post(self.device, lambda: self._pixel.fill(color), PRIO_LED, 'fill')
+
+  def brightness(self, value):
+    self._brightness = value
+    self._i2c.post(self.device, lambda: setattr(self._pixel, 'brightness', value), PRIO_LED, 'brightness')
+
+  def enable_interrupts(self):
+    """ Raise INT on button or encoder changes """
+    self._i2c.call(self.device, self._enable)
+    self._interrupts = True
+
+  def _enable(self):
+    self._ss.set_GPIO_interrupts(1 << self._button_pin, True)
+    self._ss.enable_encoder_interrupt()
+    self._ss.get_GPIO_interrupt_flag()
+
+  def clear_interrupt(self):
+    self._i2c.call(self.device, self._ss.get_GPIO_interrupt_flag)
@@ -0,0 +1,142 @@
+import time
+import logging
+import threading
+from ringq import RingQueue, DEFAULT_CAPACITY
+
+"""
+Ingest channel class
+
+Single multiplexed channel between the data producers (temp probes,
+controllers, Tilts) and the consumers (uploader, local store).  Each
+producer gets its own source which looks like a queue (put/empty/qsize)
+so the producers don't need to know about the channel.  Each consumer
+gets a reader which sees everything put into any source after it was
+created.  Putting into a source wakes the readers, which then drain
+everything that is ready in one pass instead of polling each queue in
+turn.
+
+Every reader keeps a bounded backlog per source (a RingQueue, see
+ringq.py); what happens when one is full depends on the queue policy and
+is counted.  Per source backlog depth, drop count and put-to-drain
+latency are available from Reader.stats(), and for every reader from
+Ingest.stats().
+
+"""
+
+logger = logging.getLogger('tiltpirelay.ingest')
+
+BLOCK_TIMEOUT_S = 1.0
+
+class Slot:
+  """ Backlog of one source for one reader """
+  __slots__ = ('q', 'latency_last', 'latency_max')
+
+  def __init__(self, channel, name):
+    self.q = RingQueue(channel._capacity, channel._policy, channel._cond, name)
+    self.latency_last = 0.0
+    self.latency_max = 0.0
+
+class Source:
+
+  def __init__(self, channel, name):
+    self.name = name
+    self._channel = channel
+    self._slots = {}   # reader name -> Slot
+
+  def put(self, item):
+    now = time.monotonic()
+    with self._channel._cond:
+      for slot in self._slots.values():
+        slot.q.put_locked((now, item), BLOCK_TIMEOUT_S)
+      self._channel._cond.notify_all()
+
+  def empty(self):
+    return self.qsize() == 0
+
+  def qsize(self):
+    """ Largest backlog of this source across the readers """
+    return max((s.q.qsize() for s in self._slots.values()), default=0)
+
+  def dropped(self):
+    """ Items discarded by this source across the readers """
+    return sum(s.q.dropped for s in self._slots.values())
+
+class Reader:
+
+  def __init__(self, channel, name):
+    self.name = name
+    self._channel = channel
+    self._cond = channel._cond
+    self._slots = {}   # source name -> Slot
+    self._woken = False
+
+  def wait(self, timeout=None):
+    """ Block until any source has data (or timeout); returns True if data is ready """
+    with self._cond:
+      ready = self._cond.wait_for(self._ready, timeout)
+      self._woken = False
+      return ready
+
+  def wake(self):
+    """ Wake the consumer without adding data (used on shutdown) """
+    with self._cond:
+      self._woken = True
+      self._cond.notify_all()
+
+  def drain(self):
+    """ Remove and return every queued item from all the sources """
+    items = []
+    now = time.monotonic()
+    with self._cond:
+      for s in self._slots.values():
+        stamped = s.q.drain_locked()
+        if stamped:
+          items.extend(item for (_, item) in stamped)
+          s.latency_last = now - stamped[-1][0]
+          s.latency_max = max(s.latency_max, now - stamped[0][0])
+      # Wake producers waiting on a full 'block' queue
+      self._cond.notify_all()
+    return items
+
+  def stats(self):
+    with self._cond:
+      return { name: dict(s.q.stats(),
+                          latency=s.latency_last,
+                          latency_max=s.latency_max)
+               for (name, s) in self._slots.items() }
+
+  def _ready(self):
+    return self._woken or any(not s.q.empty() for s in self._slots.values())
+
+class Ingest:
+
+  def __init__(self, capacity=DEFAULT_CAPACITY, policy='drop-oldest'):
+    self._capacity = capacity
+    self._policy = policy
+    self._cond = threading.Condition()
+    self._sources = {}
+    self._readers = {}
+
+  def source(self, name):
+    with self._cond:
+      if name not in self._sources:
+        src = Source(self, name)
+        for r in self._readers.values():
+          src._slots[r.name] = r._slots[name] = Slot(self, f"{name}->{r.name}")
+        self._sources[name] = src
+      return self._sources[name]
+
+  def stats(self):
+    """ Reader name -> per source backlog depth, drops and latency """
+    with self._cond:
+      readers = list(self._readers.values())
+    return { r.name: r.stats() for r in readers }
+
+  def reader(self, name):
+    with self._cond:
+      if name not in self._readers:
+        r = Reader(self, name)
+        for src in self._sources.values():
+          src._slots[name] = r._slots[src.name] = Slot(self, f"{src.name}->{name}")
+        self._readers[name] = r
+      return self._readers[name]
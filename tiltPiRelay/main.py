@@ -1,9 +1,8 @@
 #!/bin/env python3
 import os
+import re
 import sys
-import time
 import signal
-import queue
 import logging
 import logging.config
 import logging.handlers
@@ -12,22 +11,30 @@ import configparser
 sys.path.append('/usr/lib/python3/dist-packages')
 import RPi.GPIO as GPIO
 from rpi_lcd import LCD
-from time import sleep
 from adafruit_seesaw import seesaw, rotaryio, digitalio
-from queue import SimpleQueue
 
-from temp import Temp
+from temp import Temp, TempSweep
+from w1 import registry, BUS_PREFIX
+from filters import DEFAULT_CHAIN
+from i2cbus import I2CBus
+from runtime import Runtime
+from settings import ChannelSettings
+from persist import ConfigPersister, load, QUIET_S
+from scheduler import Scheduler
 from controller import Controller
 from system import System
 from tilt import TiltScanner
-from adafruit import IOAdafruit
-
-# Time between passes on main event loop
-MAIN_LOOP_WAIT_MS = 250
+from adafruit import IOAdafruit, DEFAULT_SPOOL_FILE, DEFAULT_MQTT_HOST, DEFAULT_MQTT_PORT
+from ingest import Ingest
+from spool import Spool
+from tsdb import Store, LocalStore, DEFAULT_RETENTION_DAYS
+from api import QueryServer, DEFAULT_PORT, DEFAULT_BIND
 
 UPDATE_RATE_MS   = 5000
+STATS_INTERVAL_S = 600
 
 CONFIGFILE = os.path.expanduser('~/.beercntlr.cfg')
+DEFAULT_TSDB_PATH = '~/.beercntlr.tsdb'
 UNSET_CREDENTIALS = 'update_this'
 
 TILTCOLORS = [ 'NONE', 'RED', 'GREEN', 'BLACK', 'PURPLE', \
@@ -49,13 +56,14 @@ GLYCOL_TEMP_BUS  = "w1_bus_master4"
 ONBOARD_TEMP_BUS = "w1_bus_master5"
 
 """
-2 channel temp controller.
+Temp controller; 2 channels as wired below, more can be configured (see
+channel_config()).
 
 Hardware Setup
   Pinout
   ------
   GPIO 2/3 (I2C) (displays, rotarys, LEDs)
-  GPIO  4: On Board (OWB)
+  GPIO 25: On Board (OWB)
   GPIO 17: Ambient (OWB)
   GPIO 23: Temp 1 (OWB)
   GPIO 27: Temp 2 (OWB)
@@ -88,63 +96,169 @@ DISP2_ADDR       = 0x27
 ROT2_ADDR        = 0x36
 DISP_SYS_ADDR    = 0x25
 
-# Globals
-run = True
+# Pins of the one-wire buses (see w1-setup.sh) and of I2C bus 1
+W1_GPIOS         = (23, 27, 17, 24, 25)
+I2C_GPIOS        = (2, 3)
 
-c1 = None
-thread1 = None
+# Hardware of the built-in channels; others need it all in their [portN]
+CHANNEL_DEFAULTS = {
+  1: { 'probe': CTLR_1_TEMP_BUS, 'heat_gpio': HEAT1_GPIO, 'cool_gpio': COOL1_GPIO,
+       'display': DISP1_ADDR, 'encoder': ROT1_ADDR },
+  2: { 'probe': CTLR_2_TEMP_BUS, 'heat_gpio': HEAT2_GPIO, 'cool_gpio': COOL2_GPIO,
+       'display': DISP2_ADDR, 'encoder': ROT2_ADDR },
+}
+CHANNEL_KEYS = ('probe', 'heat_gpio', 'cool_gpio', 'display', 'encoder')
 
-c2 = None
-thread2 = None
+# Globals
+run = True
 
+controllers = []
 tilt = None
-tilt_thread = None
+sysinfo = None
 
 aio = None
 adafruit_thread = None
 
-sysinfo = None
-sysinfo_thread = None
+store = None
+store_thread = None
+
+api = None
+api_thread = None
+
+w1 = None
+
+i2c = None
+i2c_thread = None
+
+runtime = None
 
 def signal_handler(sig, frame):
-  global run, thread1, thread2, tilt, tilt_thread, aio, adafruit_thread, c1, c2, sysinfo, sysinfo_thread
+  global run, runtime
   logger.warning("Shutting Down")
   run = False
-  if c1:
-    c1.end()
-  if c2:
-    c2.end()
+  if runtime:
+    # main() shuts down once the runtime has stopped
+    runtime.end()
+  else:
+    shutdown()
+
+def shutdown():
+  global tilt, aio, adafruit_thread, controllers, sysinfo, store, store_thread, api, api_thread, w1, i2c, i2c_thread
+  for c in controllers:
+    c.end()
   if sysinfo:
     sysinfo.end()
   if tilt:
     tilt.end()
   if aio:
     aio.end()
-  if thread1:
-    thread1.join()
-    logger.debug("thread 1 done")
-  if thread2:
-    thread2.join()
-    logger.debug("thread 2 done")
-  if sysinfo_thread:
-    sysinfo_thread.join()
-    logger.debug("sysinfo thread done")
-  if tilt_thread:
-    tilt_thread.join()
-    logger.debug("tilt thread done")
+  if store:
+    store.end()
+  if api:
+    api.end()
+  if w1:
+    w1.end()
   if adafruit_thread:
     adafruit_thread.join()
     logger.debug("adafruit thread done")
+  if store_thread:
+    store_thread.join()
+    logger.debug("store thread done")
+  if api_thread:
+    api_thread.join()
+    logger.debug("api thread done")
+  # Last; the other threads write their shutdown messages through it
+  if i2c:
+    i2c.end()
+  if i2c_thread:
+    i2c_thread.join()
+    logger.debug("i2c thread done")
   logger.debug("done")
 
+def sensor_config(config):
+  """ name -> (bus, ROM ID) of the probes listed in the [sensors] section """
+  sensors = {}
+  if 'sensors' in config:
+    for (name, value) in config['sensors'].items():
+      if name in config.defaults():
+        continue
+      sensors[name] = probe_spec(value)
+  return sensors
+
+def probe_spec(value):
+  """ (bus, ROM ID) from 'bus/ROM', 'ROM' or 'bus' """
+  (bus, _, rom) = value.strip().rpartition('/')
+  if not bus and rom.startswith(BUS_PREFIX):
+    return (rom, None)
+  return (bus or None, rom)
+
+def channel_config(config, sensors):
+  """
+  Controller channels, one for each [portN] section:
+    (N, section, (bus, ROM ID), heat GPIO, cool GPIO, display address, encoder address)
+
+  A channel is set up by these keys in its section (ports 1 and 2 default
+  to the hardware above):
+    probe      temp probe as in [sensors]: bus, ROM ID or bus/ROM ID
+               (a tempN entry in [sensors] takes precedence)
+    heat_gpio  BCM GPIO of the heat relay
+    cool_gpio  BCM GPIO of the cool relay
+    display    I2C address of the LCD (e.g. 0x28)
+    encoder    I2C address of the seesaw rotary encoder
+  along with its setpoint, tiltcolor, window and int_gpio.
+
+  A channel whose GPIOs or I2C addresses are already claimed (by an
+  earlier channel, the one-wire or I2C buses or the system display) is
+  not started.
+  """
+  channels = []
+  gpios = { pin: 'one-wire bus' for pin in W1_GPIOS }
+  gpios.update((pin, 'I2C bus') for pin in I2C_GPIOS)
+  addrs = { DISP_SYS_ADDR: 'system display' }
+  ports = sorted(int(m.group(1)) for m in
+                 (re.fullmatch(r'port(\d+)', s) for s in config.sections()) if m)
+  for n in ports:
+    section = config[f"port{n}"]
+    hw = dict(CHANNEL_DEFAULTS.get(n, {}))
+    hw.update((k, section[k]) for k in CHANNEL_KEYS if k in section)
+    missing = [k for k in CHANNEL_KEYS if k not in hw]
+    if missing:
+      logger.error(f"[port{n}] needs {', '.join(missing)}; channel not started")
+      continue
+    try:
+      heat = int(hw['heat_gpio'])
+      cool = int(hw['cool_gpio'])
+      display = int(str(hw['display']), 0)
+      encoder = int(str(hw['encoder']), 0)
+      pins = { 'heat_gpio': heat, 'cool_gpio': cool }
+      if section.getint('int_gpio', fallback=None) is not None:
+        pins['int_gpio'] = section.getint('int_gpio')
+      used = [f"{k} {v} (also {gpios[v]})" for (k, v) in pins.items() if v in gpios]
+      used += [f"{k} 0x{v:02x} (also {addrs[v]})"
+               for (k, v) in (('display', display), ('encoder', encoder)) if v in addrs]
+      if len(set(pins.values())) < len(pins):
+        used.append(f"GPIOs {', '.join(f'{k}={v}' for (k, v) in pins.items())} overlap")
+      if display == encoder:
+        used.append(f"display and encoder both 0x{display:02x}")
+      if used:
+        logger.error(f"[port{n}] hardware already in use: {'; '.join(used)}; channel not started")
+        continue
+      probe = sensors.pop(f"temp{n}", None) or probe_spec(str(hw['probe']))
+      gpios.update((v, f"[port{n}] {k}") for (k, v) in pins.items())
+      addrs.update({ display: f"[port{n}] display", encoder: f"[port{n}] encoder" })
+      channels.append((n, section, probe, heat, cool, display, encoder))
+    except ValueError as e:
+      logger.error(f"[port{n}] invalid: {e}; channel not started")
+  return channels
+
 def main():
-  global run, thread1, thread2, tilt_thread, aio, adafruit_thread, c1, c2, sysinfo, sysinfo_thread, tilt
+  global run, aio, adafruit_thread, controllers, sysinfo, tilt, store, store_thread, api, api_thread, w1, i2c, i2c_thread, runtime
 
   signal.signal(signal.SIGINT, signal_handler)
   signal.signal(signal.SIGTERM, signal_handler)
 
   config = configparser.ConfigParser()
-  config.read(CONFIGFILE)
+  load(config, CONFIGFILE)
   logger.debug("Begin")
 
   # Add default values in case config file was missing/empty
@@ -164,81 +278,164 @@ def main():
   if 'port2' not in config:
     config['port2'] = {}
 
-  # Thread to monitor Tilts
-  tilt = TiltScanner()
-  tilt_thread = threading.Thread(target=tilt.control_thread, daemon=True)
-  tilt_thread.start()
-
-  t1 = Temp("temp1", CTLR_1_TEMP_BUS)
-  q1 = queue.SimpleQueue()
-  c1 = Controller('ctrl-1', config['port1'], HEAT1_GPIO, COOL1_GPIO,
-                  t1, tilt, DISP1_ADDR, ROT1_ADDR);
+  # All the data to be reported goes through one channel
+  ingest = Ingest(capacity=config['system'].getint('queue_size', fallback=1000),
+                  policy=config['system'].get('queue_policy', 'drop-oldest'))
 
-  t2 = Temp("temp2", CTLR_2_TEMP_BUS)
-  q2 = queue.SimpleQueue()
-  c2 = Controller('ctrl-2', config['port2'], HEAT2_GPIO, COOL2_GPIO,
-                  t2, tilt, DISP2_ADDR, ROT2_ADDR);
+  # Counters of the parts; logged every stats_interval and at shutdown,
+  # and served at /stats
+  monitors = { 'ingest': ingest.stats }
 
-  # Start Controller UI/control logic
-  thread1 = threading.Thread(target=c1.control_thread, daemon=True)
-  thread1.start()
-  thread2 = threading.Thread(target=c2.control_thread, daemon=True)
-  thread2.start()
+  def stats():
+    return { name: fn() for (name, fn) in monitors.items() }
 
-  t_amb = Temp("ambient", AMBIENT_TEMP_BUS)
-  q_amb = queue.SimpleQueue()
-  t_gly = Temp("glycol", GLYCOL_TEMP_BUS)
-  q_gly = queue.SimpleQueue()
+  def log_stats():
+    for (name, value) in stats().items():
+      logger.info(f"Stats {name}: {value}")
 
-  sysinfo = System(DISP_SYS_ADDR, t_amb, t_gly)
-  sysinfo_thread = threading.Thread(target=sysinfo.system_thread, daemon=True)
-  sysinfo_thread.start()
-
-  t_int = Temp("internal", ONBOARD_TEMP_BUS)
-  q_int = queue.SimpleQueue()
+  # The controllers, displays, probe sampling and BLE scans run on the
+  # deadline scheduler, or with runtime = asyncio as tasks on one event loop
+  if config['system'].get('runtime', 'scheduler') == 'asyncio':
+    runtime = Runtime()
+  else:
+    runtime = Scheduler()
+
+  # Monitor Tilts
+  tilt = TiltScanner(ingest)
+  runtime.every('tilt', tilt.step)
+
+  # Thread which owns the I2C bus (displays and knobs)
+  i2c = I2CBus(1)
+  i2c_thread = threading.Thread(target=i2c.bus_thread, daemon=True)
+  i2c_thread.start()
+  monitors['i2c'] = i2c.stats
+
+  # Pick up temp probes being plugged in / removed
+  w1 = registry()
+  runtime.every('w1', w1.step)
+
+  # Probes can be given by ROM ID (and bus) in the [sensors] section
+  sensors = sensor_config(config)
+  filters = config['system'].get('filters', DEFAULT_CHAIN)
+
+  # Controller UI/control logic; each channel is a task on the shared runtime
+  probes = []
+  ports = []
+
+  def save_settings():
+    for (settings, section) in ports:
+      settings.write(section)
+
+  # Changes are saved in the background once they have settled
+  persister = ConfigPersister(config, CONFIGFILE,
+                              quiet=config['system'].getfloat('save_delay', fallback=QUIET_S),
+                              prepare=save_settings)
+  runtime.every('persist', persister.step, persister)
+  runtime.on_shutdown(persister.flush)
+  if config['system'].getboolean('updated'):
+    # New config file
+    config['system']['updated'] = 'False'
+    persister.changed()
+
+  for (n, section, probe, heat, cool, display, encoder) in channel_config(config, sensors):
+    t = Temp(f"temp{n}", *probe, w1, filters)
+    probes.append((t, ingest.source(f"temp{n}"), True))
+    settings = ChannelSettings(section)
+    settings.listen(lambda old, new: persister.changed())
+    c = Controller(f"ctrl-{n}", settings, heat, cool, t, tilt, display, encoder, ingest,
+                   section.getint('int_gpio', fallback=None), i2c)
+    controllers.append(c)
+    ports.append((settings, section))
+    runtime.every(f"ctrl-{n}", c.step, c)
+    runtime.on_shutdown(c.shutdown)
+
+  t_amb = Temp("ambient", *sensors.pop("ambient", (AMBIENT_TEMP_BUS, None)), w1, filters)
+  q_amb = ingest.source('ambient')
+  t_gly = Temp("glycol", *sensors.pop("glycol", (GLYCOL_TEMP_BUS, None)), w1, filters)
+  q_gly = ingest.source('glycol')
+
+  sysinfo = System(DISP_SYS_ADDR, t_amb, t_gly, i2c)
+  runtime.every('system', sysinfo.step)
+  runtime.on_shutdown(sysinfo.shutdown)
+
+  t_int = Temp("internal", *sensors.pop("internal", (ONBOARD_TEMP_BUS, None)), w1, filters)
+  q_int = ingest.source('internal')
 
   # Thread to upload data
   if ((config['system']['aio_user'] == UNSET_CREDENTIALS) or
       (config['system']['aio_user'] == UNSET_CREDENTIALS)):
     print(f"Set AIO username / key in {CONFIGFILE} to upload data")
   else:
-    aio = IOAdafruit(user=config['system']['aio_user'],
-                     key=config['system']['aio_key'],
-                     interval=int(config['system']['interval']))
-    aio.add_q(c1.q)
-    aio.add_q(c2.q)
-    aio.add_q(q1)
-    aio.add_q(q2)
-    aio.add_q(q_amb)
-    aio.add_q(q_gly)
-    aio.add_q(q_int)
-    for q in tilt.q.values():
-      aio.add_q(q)
-    adafruit_thread = threading.Thread(target=aio.control_thread, daemon=True)
-    adafruit_thread.start()
+    spool = Spool(os.path.expanduser(config['system'].get('spool', DEFAULT_SPOOL_FILE)),
+                  max_rows=config['system'].getint('spool_max_rows', fallback=500000),
+                  max_age=config['system'].getfloat('spool_max_days', fallback=30) * 24 * 3600)
+    options = { 'user': config['system']['aio_user'],
+                'key': config['system']['aio_key'],
+                'interval': int(config['system']['interval']),
+                'batch': config['system'].getboolean('batch', fallback=True),
+                'max_batch': config['system'].getint('batch_max', fallback=20),
+                'spool': spool,
+                'aggregate': config['system'].get('aggregate', 'mean'),
+                'channel': ingest.reader('adafruit'),
+                'feed_cache': os.path.splitext(CONFIGFILE)[0] + '.feeds.json' }
+    if config['system'].get('uploader', 'thread') == 'asyncio':
+      # Optional backend; needs aiohttp
+      from aioadafruit import AsyncIOAdafruit
+      aio = AsyncIOAdafruit(rate_limit=config['system'].getint('rate_limit', fallback=30),
+                            max_inflight=config['system'].getint('max_inflight', fallback=4),
+                            **options)
+    else:
+      aio = IOAdafruit(transport=config['system'].get('transport', 'rest'),
+                       mqtt_host=config['system'].get('mqtt_host', DEFAULT_MQTT_HOST),
+                       mqtt_port=config['system'].getint('mqtt_port', fallback=DEFAULT_MQTT_PORT),
+                       mqtt_tls=config['system'].getboolean('mqtt_tls', fallback=True),
+                       **options)
+    monitors['adafruit'] = aio.stats
+    if isinstance(runtime, Runtime) and hasattr(aio, '_main'):
+      # The asyncio uploader runs on the shared event loop
+      runtime.coroutine('adafruit', aio._main, aio.end)
+    else:
+      adafruit_thread = threading.Thread(target=aio.control_thread, daemon=True)
+      adafruit_thread.start()
+
+  # Thread to record data locally
+  if config['system'].getboolean('tsdb', fallback=True):
+    retention = { level: config['system'].getfloat(f"tsdb_{level}_days", fallback=days)
+                  for (level, days) in DEFAULT_RETENTION_DAYS.items() }
+    store = LocalStore(Store(os.path.expanduser(config['system'].get('tsdb_path', DEFAULT_TSDB_PATH)),
+                             retention),
+                       ingest.reader('tsdb'))
+    store_thread = threading.Thread(target=store.control_thread, daemon=True)
+    store_thread.start()
+
+    # Thread to serve the local data
+    port = config['system'].getint('http_port', fallback=DEFAULT_PORT)
+    if port:
+      api = QueryServer(store.store, port, config['system'].get('http_bind', DEFAULT_BIND), stats)
+      api_thread = threading.Thread(target=api.serve_thread, daemon=True)
+      api_thread.start()
+
+  # Any other probes just report their temperature
+  probes += [(t_amb, q_amb), (t_gly, q_gly), (t_int, q_int)]
+  for (name, (bus, rom)) in sensors.items():
+    probes.append((Temp(name, bus, rom, w1, filters), ingest.source(name)))
+
+  # Read all the probes in parallel; the controller probes get priority
+  sweep = TempSweep(probes)
+  monitors['sweep'] = sweep.stats
+  monitors['probes'] = sweep.schedule
+  monitors['filters'] = sweep.filter_stats
+
+  interval = config['system'].getfloat('stats_interval', fallback=STATS_INTERVAL_S)
+  if interval > 0:
+    runtime.every('stats', log_stats, period=interval)
 
   logger.debug("Staring main loop")
-  while run:
-    last_time = time.time()
-
-    t1.get_temp(q1)
-    t2.get_temp(q2)
-    t_amb.get_temp(q_amb)
-    t_gly.get_temp(q_gly)
-    t_int.get_temp(q_int)
-
-    if config['system'].getboolean('updated') or \
-       config['port1'].getboolean('updated') or \
-       config['port2'].getboolean('updated'):
-      logger.debug("Change found, update configfile")
-      config['system']['updated'] = 'False'
-      config['port1']['updated'] = 'False'
-      config['port2']['updated'] = 'False'
-      with open(CONFIGFILE, 'w') as configfile:
-        config.write(configfile)
-
-    while (time.time() - last_time) < (MAIN_LOOP_WAIT_MS / 1000.0):
-      sleep(0.005)
+  runtime.every('main', sweep.step)
+  runtime.run()
+  logger.info(f"Config saves: {persister.stats()}")
+  log_stats()
+  shutdown()
 
 if __name__ == "__main__":
   logger = logging.getLogger('tiltpirelay')
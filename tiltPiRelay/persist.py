@@ -0,0 +1,168 @@
+import io
+import os
+import time
+import shutil
+import logging
+import threading
+import configparser
+
+"""
+Config file persistence
+
+Saves ~/.beercntlr.cfg behind the controllers' backs.  A change only
+marks the config dirty; the file is written once the changes have been
+quiet for QUIET_S (turning a knob through 50 detents is one write, not
+50), or at the latest MAX_DELAY_S after the first unsaved change.
+
+Writes are atomic: the new contents go to a temp file which is fsync'd
+and renamed over the config file, so a power cut leaves either the old
+or the new file, never a truncated one.  The previous file is kept as
+<file>.bak (a hard link; no extra data written) and load() falls back to
+it if the config file is missing or unreadable.
+
+step() runs on the scheduler (scheduler.py); changed() wakes it.  Change
+and write counts (and how many changes were coalesced) are in stats().
+
+"""
+
+logger = logging.getLogger('tiltpirelay.persist')
+
+QUIET_S = 5.0
+MAX_DELAY_S = 60.0
+IDLE_S = 3600.0
+
+def load(config, path):
+  """ Read the config file, or its backup if it's missing or corrupt """
+  for name in (path, path + '.bak'):
+    if not os.path.exists(name) or os.path.getsize(name) == 0:
+      continue
+    try:
+      config.read(name)
+      if name != path:
+        logger.warning(f"Config {path} missing or unreadable; loaded backup {name}")
+      return name
+    except (configparser.Error, UnicodeDecodeError) as e:
+      logger.error(f"Can't read config {name}: {e}")
+      for section in config.sections():
+        config.remove_section(section)
+      config.defaults().clear()
+  return None
+
+class ConfigPersister:
+
+  def __init__(self, config, path, quiet=QUIET_S, max_delay=MAX_DELAY_S, prepare=None):
+    self._config = config
+    self._path = path
+    self._quiet = quiet
+    self._max_delay = max_delay
+    # Called before each write to bring the config up to date
+    self._prepare = prepare
+    self._lock = threading.Lock()
+    self._first = None   # first unsaved change
+    self._last = None    # latest unsaved change
+    self._pending = 0
+    self.changes = 0
+    self.writes = 0
+    self.coalesced = 0   # changes saved by another change's write
+    self.errors = 0
+    # Set by the scheduler; called when a change is made
+    self.waker = None
+
+  def changed(self):
+    """ Note a change to the config; it will be saved once things are quiet """
+    now = time.monotonic()
+    with self._lock:
+      self.changes += 1
+      self._pending += 1
+      if self._first is None:
+        self._first = now
+      self._last = now
+    if self.waker:
+      self.waker()
+
+  def due(self):
+    """ Seconds until the pending changes should be written (None if none) """
+    with self._lock:
+      if self._first is None:
+        return None
+      at = min(self._last + self._quiet, self._first + self._max_delay)
+    return max(0.0, at - time.monotonic())
+
+  def step(self):
+    """ Write the config if it's due; returns the seconds until the next check """
+    delay = self.due()
+    if delay is None:
+      return IDLE_S
+    if delay > 0:
+      return delay
+    self.flush()
+    delay = self.due()
+    return IDLE_S if delay is None else delay
+
+  def flush(self):
+    """ Write any pending changes now """
+    with self._lock:
+      if self._first is None:
+        return False
+      pending = self._pending
+      self._first = self._last = None
+      self._pending = 0
+    try:
+      self.write()
+    except OSError as e:
+      logger.error(f"Can't save config {self._path}: {e}")
+      # Try again after another quiet period
+      now = time.monotonic()
+      with self._lock:
+        self.errors += 1
+        self._pending += pending
+        self._first = self._first or now
+        self._last = now
+      return False
+    with self._lock:
+      self.coalesced += pending - 1
+    return True
+
+  def write(self):
+    if self._prepare:
+      self._prepare()
+    buf = io.StringIO()
+    self._config.write(buf)
+
+    tmp = self._path + '.tmp'
+    with open(tmp, 'w') as f:
+      f.write(buf.getvalue())
+      f.flush()
+      os.fsync(f.fileno())
+    if os.path.exists(self._path):
+      self._backup()
+    os.replace(tmp, self._path)
+    # Make the rename itself durable
+    fd = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+    self.writes += 1
+    logger.debug(f"Saved config {self._path} ({self.changes} changes in {self.writes} writes)")
+
+  def _backup(self):
+    bak = self._path + '.bak'
+    tmp = bak + '.tmp'
+    try:
+      if os.path.exists(tmp):
+        os.unlink(tmp)
+      os.link(self._path, tmp)
+    except OSError:
+      # Filesystem without hard links
+      shutil.copyfile(self._path, tmp)
+    os.replace(tmp, bak)
+
+  def stats(self):
+    with self._lock:
+      return { 'changes': self.changes,
+               'writes': self.writes,
+               'coalesced': self.coalesced,
+               'errors': self.errors,
+               'pending': self._pending }
@@ -0,0 +1,103 @@
+import queue
+import logging
+import threading
+from collections import deque
+
+"""
+Bounded ring queue class
+
+Drop in replacement for queue.SimpleQueue (put/get/empty/qsize) with a
+fixed capacity so a queue nobody reads can't grow until the Pi runs out
+of memory.  What happens when it's full depends on the policy:
+
+  drop-oldest      discard the oldest item to make room (default)
+  coalesce-latest  replace the newest item with the new one, keeping the
+                   older history and always the latest value
+  block            wait (up to the put timeout) for room; if there still
+                   isn't any the new item is discarded
+
+Dropped, coalesced and blocked puts are counted and available from
+stats().  The queue can share a threading.Condition with other objects
+(see ingest.py) so a consumer can wait on several queues at once.
+
+"""
+
+logger = logging.getLogger('tiltpirelay.ringq')
+
+POLICIES = ['drop-oldest', 'coalesce-latest', 'block']
+DEFAULT_CAPACITY = 1000
+
+class RingQueue:
+
+  def __init__(self, capacity=DEFAULT_CAPACITY, policy='drop-oldest', cond=None, name=None):
+    if policy not in POLICIES:
+      raise ValueError(f"Unknown queue policy: {policy}")
+    self.capacity = max(1, capacity)
+    self.policy = policy
+    self.name = name
+    self.dropped = 0
+    self.coalesced = 0
+    self.blocked = 0
+    self._items = deque()
+    self._cond = cond or threading.Condition()
+
+  def put(self, item, timeout=None):
+    with self._cond:
+      self.put_locked(item, timeout)
+      self._cond.notify_all()
+
+  def put_locked(self, item, timeout=None):
+    """ put() for callers already holding the condition; doesn't notify """
+    if len(self._items) >= self.capacity:
+      if self.policy == 'coalesce-latest':
+        self._items[-1] = item
+        self.coalesced += 1
+        return
+      if self.policy == 'block':
+        self.blocked += 1
+        if self._cond.wait_for(lambda: len(self._items) < self.capacity, timeout):
+          self._items.append(item)
+          return
+      else:
+        self._items.popleft()
+      self.dropped += 1
+      if self.dropped == 1 or (self.dropped % 100) == 0:
+        logger.warning(f"Queue {self.name} full; dropped {self.dropped} items")
+      if self.policy == 'block':
+        return
+    self._items.append(item)
+
+  def get(self, block=True, timeout=None):
+    with self._cond:
+      if block and not self._cond.wait_for(lambda: self._items, timeout):
+        raise queue.Empty
+      if not self._items:
+        raise queue.Empty
+      item = self._items.popleft()
+      self._cond.notify_all()
+      return item
+
+  def get_nowait(self):
+    return self.get(False)
+
+  def drain_locked(self):
+    """ Remove and return every item; caller holds the condition and notifies """
+    items = list(self._items)
+    self._items.clear()
+    return items
+
+  def empty(self):
+    return not self._items
+
+  def full(self):
+    return len(self._items) >= self.capacity
+
+  def qsize(self):
+    return len(self._items)
+
+  def stats(self):
+    return { 'depth': len(self._items),
+             'capacity': self.capacity,
+             'dropped': self.dropped,
+             'coalesced': self.coalesced,
+             'blocked': self.blocked }
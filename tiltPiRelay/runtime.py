@@ -0,0 +1,165 @@
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Asyncio runtime
+
+Alternative to the deadline scheduler and its worker threads
+(runtime = asyncio in [system]).  The controllers, the system display,
+probe sampling, the one-wire rescan and the BLE scans are tasks on one
+event loop.  Each task calls a step function which does one pass of work
+and returns how long until it next needs to run; the task then sleeps
+for exactly that long (or until it is woken, e.g. by a knob interrupt)
+instead of polling.  Steps which block (I2C, one-wire and BLE I/O) run
+in a small thread pool so they don't hold up the loop; coroutines (the
+asyncio uploader) run on the loop directly.
+
+The threaded uploader, local store, query API and I2C bus keep their
+own threads; they already sleep until there is work for them.  The
+interface matches scheduler.Scheduler, the default runtime.
+
+Running this module benchmarks CPU time, context switches (wakeups) and
+threads of the scheduler and asyncio runtimes on simulated hardware (see
+sim.py).
+
+"""
+
+logger = logging.getLogger('tiltpirelay.runtime')
+
+IO_WORKERS = 4
+
+class Runtime:
+
+  def __init__(self, workers=IO_WORKERS):
+    self._workers = workers
+    self._steps = []       # (name, step, target, blocking)
+    self._coroutines = []  # (name, coroutine function, stop)
+    self._shutdown = []    # called after the loop has stopped
+    self._loop = None
+    self._stop = None
+
+  def every(self, name, step, target=None, period=None, blocking=True):
+    """
+    Run step() every period seconds or, without a period, repeatedly
+    sleeping for the seconds it returns in between.  If target has a
+    'waker' attribute it is set to a function which cuts the sleep short
+    (safe to call from any thread).
+    """
+    self._steps.append((name, step, target, period, blocking))
+
+  def coroutine(self, name, fn, stop=None):
+    """
+    Run the coroutine fn() as a task until it returns.  stop() is called
+    when the runtime is ending, before the task is cancelled, to release
+    anything the coroutine is blocked on outside the loop (e.g. a wait
+    in an executor thread, which asyncio.run would otherwise wait for).
+    """
+    self._coroutines.append((name, fn, stop))
+
+  def on_shutdown(self, fn):
+    self._shutdown.append(fn)
+
+  def run(self):
+    """ Run the tasks until end() is called """
+    asyncio.run(self._main())
+    for fn in self._shutdown:
+      try:
+        fn()
+      except Exception as e:
+        logger.error(f"Shutdown failed: {e}")
+
+  def end(self):
+    if self._loop:
+      self._loop.call_soon_threadsafe(self._stop.set)
+
+  async def _main(self):
+    self._loop = asyncio.get_running_loop()
+    self._stop = asyncio.Event()
+    self._io = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='io')
+    tasks = [asyncio.create_task(self._every(*s), name=s[0]) for s in self._steps]
+    tasks += [asyncio.create_task(fn(), name=name) for (name, fn, _) in self._coroutines]
+    logger.info(f"asyncio runtime running {len(tasks)} tasks")
+
+    await self._stop.wait()
+    for (name, _, stop) in self._coroutines:
+      if stop:
+        try:
+          stop()
+        except Exception as e:
+          logger.error(f"Stopping {name} failed: {e}")
+    for t in tasks:
+      t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    self._io.shutdown(wait=True)
+
+  async def _every(self, name, step, target, period, blocking):
+    wake = asyncio.Event()
+    if target is not None and hasattr(target, 'waker'):
+      target.waker = lambda: self._loop.call_soon_threadsafe(wake.set)
+    while True:
+      wake.clear()
+      begin = self._loop.time()
+      try:
+        if blocking:
+          delay = await self._loop.run_in_executor(self._io, step)
+        else:
+          delay = step()
+      except Exception as e:
+        logger.error(f"Task {name} failed: {e}")
+        delay = 1.0
+      if period is not None:
+        delay = period - (self._loop.time() - begin)
+      if delay and delay > 0:
+        try:
+          await asyncio.wait_for(wake.wait(), delay)
+        except asyncio.TimeoutError:
+          pass
+      else:
+        # Let the other tasks run
+        await asyncio.sleep(0)
+
+if __name__ == "__main__":
+
+  import os
+  import sys
+  import json
+  import resource
+  import threading
+  import subprocess
+
+  SECONDS = 20
+
+  def measure(mode, knobs, seconds):
+    import sim
+    system = sim.System(channels=2, interrupts=(knobs == 'int'))
+    begin_cpu = time.process_time()
+    begin_ru = resource.getrusage(resource.RUSAGE_SELF)
+    begin = time.monotonic()
+    threads = system.start(mode)
+    time.sleep(seconds)
+    threads = max(threads, threading.active_count())
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    elapsed = time.monotonic() - begin
+    cpu = time.process_time() - begin_cpu
+    system.stop()
+    return { 'mode': mode,
+             'knobs': knobs,
+             'cpu_pct': 100.0 * cpu / elapsed,
+             'wakeups_per_s': ((ru.ru_nvcsw + ru.ru_nivcsw) -
+                               (begin_ru.ru_nvcsw + begin_ru.ru_nivcsw)) / elapsed,
+             'threads': threads }
+
+  if len(sys.argv) > 1:
+    # One run per process so the counters don't mix
+    print(json.dumps(measure(sys.argv[1], sys.argv[2], float(sys.argv[3]))))
+    sys.exit(0)
+
+  for knobs in ('poll', 'int'):
+    for mode in ('scheduler', 'asyncio'):
+      out = subprocess.run([sys.executable, __file__, mode, knobs, str(SECONDS)],
+                           capture_output=True, text=True, check=True).stdout
+      r = json.loads(out.splitlines()[-1])
+      print(f"{r['mode']:>9s} ({r['knobs']:4s} knobs): {r['cpu_pct']:5.1f}% CPU  "
+            f"{r['wakeups_per_s']:6.0f} wakeups/s  {r['threads']:3d} threads")
@@ -0,0 +1,228 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Deadline scheduler
+
+Runs the periodic work (controllers, system display, probe sampling, BLE
+scans, one-wire rescan) without each part spinning in its own sleep
+loop.  Every task has a deadline on the monotonic clock (so NTP stepping
+the wall clock doesn't stretch or squash the intervals); the deadlines
+are kept in a heap and the scheduler thread does a single sleep until the
+earliest one.  There is no polling: when nothing is due nothing wakes up.
+
+A task is a step function.  With a period it runs at a fixed rate (every
+period seconds from its previous deadline); without one the step returns
+how many seconds until it next needs to run.  A task can be woken early
+(e.g. by a knob interrupt) through the 'waker' attribute set on its
+target.  Steps run on worker threads, one at most per task, so a slow
+step (a probe sweep, a BLE scan) doesn't hold up the others.
+
+Overruns are counted per task: a step which starts more than OVERRUN_S
+after its deadline, or runs longer than its period.  See stats().  The
+interface matches runtime.Runtime so main.py can run either.
+
+Running this module benchmarks the controller loop latency with 2 to 16
+channels on simulated hardware (see sim.py).
+
+"""
+
+logger = logging.getLogger('tiltpirelay.scheduler')
+
+OVERRUN_S = 0.05
+
+class Task:
+  __slots__ = ('name', 'step', 'period', 'deadline', 'running', 'woken',
+               'runs', 'late', 'overruns', 'late_max', 'late_total', 'run_max', 'run_total')
+
+  def __init__(self, name, step, period):
+    self.name = name
+    self.step = step
+    self.period = period
+    self.deadline = None
+    self.running = False
+    self.woken = False
+    self.runs = 0
+    self.late = 0        # started more than OVERRUN_S after the deadline
+    self.overruns = 0    # ran longer than the period
+    self.late_max = 0.0
+    self.late_total = 0.0
+    self.run_max = 0.0
+    self.run_total = 0.0
+
+  def stats(self):
+    return { 'task': self.name,
+             'runs': self.runs,
+             'late': self.late,
+             'overruns': self.overruns,
+             'late_max': self.late_max,
+             'late_avg': self.late_total / self.runs if self.runs else 0.0,
+             'run_max': self.run_max,
+             'run_avg': self.run_total / self.runs if self.runs else 0.0 }
+
+class Scheduler:
+
+  def __init__(self, overrun=OVERRUN_S):
+    self._overrun = overrun
+    self._tasks = []
+    self._heap = []      # (deadline, seq, task); stale entries are skipped
+    self._seq = 0
+    self._cond = threading.Condition()
+    self._run = True
+    self._shutdown = []
+    self._pool = None
+
+  def every(self, name, step, target=None, period=None):
+    """
+    Run step() every period seconds, or, without a period, after the
+    number of seconds it returns.  If target has a 'waker' attribute it is
+    set to a function which makes the task due now (safe to call from any
+    thread, including interrupt callbacks).
+    """
+    task = Task(name, step, period)
+    self._tasks.append(task)
+    if target is not None and hasattr(target, 'waker'):
+      target.waker = lambda: self.wake(task)
+    with self._cond:
+      self._push(task, time.monotonic())
+
+  def on_shutdown(self, fn):
+    self._shutdown.append(fn)
+
+  def wake(self, task):
+    with self._cond:
+      if task.running:
+        # Run again as soon as this pass finishes
+        task.woken = True
+      elif task.deadline is None or task.deadline > time.monotonic():
+        self._push(task, time.monotonic())
+        self._cond.notify()
+
+  def _push(self, task, deadline):
+    task.deadline = deadline
+    self._seq += 1
+    heapq.heappush(self._heap, (deadline, self._seq, task))
+
+  def run(self):
+    """ Run the tasks until end() is called """
+    # One worker per task; a task never waits for another to free a worker
+    self._pool = ThreadPoolExecutor(max_workers=max(1, len(self._tasks)),
+                                    thread_name_prefix='sched')
+    logger.info(f"Scheduler running {len(self._tasks)} tasks")
+    with self._cond:
+      while self._run:
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+          (deadline, _, task) = heapq.heappop(self._heap)
+          if task.running or deadline != task.deadline:
+            continue
+          task.running = True
+          self._pool.submit(self._call, task, deadline)
+        # The one sleep: until the earliest deadline or a wake()/finish
+        self._cond.wait(self._heap[0][0] - now if self._heap else None)
+    self._pool.shutdown(wait=True)
+    for fn in self._shutdown:
+      try:
+        fn()
+      except Exception as e:
+        logger.error(f"Shutdown failed: {e}")
+    for s in self.stats():
+      logger.info(f"Task {s['task']}: {s['runs']} runs, {s['late']} late (max {s['late_max']:.3f}s), " +
+                  f"{s['overruns']} overruns (run max {s['run_max']:.3f}s)")
+
+  def _call(self, task, deadline):
+    begin = time.monotonic()
+    try:
+      delay = task.step()
+    except Exception as e:
+      logger.error(f"Task {task.name} failed: {e}")
+      delay = 1.0
+    now = time.monotonic()
+
+    with self._cond:
+      task.running = False
+      task.runs += 1
+      late = begin - deadline
+      task.late_max = max(task.late_max, late)
+      task.late_total += late
+      task.run_max = max(task.run_max, now - begin)
+      task.run_total += now - begin
+      if late > self._overrun:
+        task.late += 1
+        self._warn(task, f"started {late:.3f}s late")
+
+      if task.period is not None:
+        # Fixed rate; after an overrun start again straight away rather
+        # than trying to catch up the missed runs
+        nxt = deadline + task.period
+        if now > nxt + self._overrun:
+          task.overruns += 1
+          self._warn(task, f"ran {now - begin:.3f}s; period is {task.period:.3f}s")
+          nxt = now
+      else:
+        nxt = now + max(0.0, delay or 0.0)
+      if task.woken:
+        task.woken = False
+        nxt = now
+      self._push(task, nxt)
+      self._cond.notify()
+
+  def _warn(self, task, msg):
+    n = task.late + task.overruns
+    if n == 1 or (n % 100) == 0:
+      logger.warning(f"Task {task.name} {msg} ({n} overruns)")
+
+  def stats(self):
+    with self._cond:
+      return [t.stats() for t in self._tasks]
+
+  def end(self):
+    with self._cond:
+      self._run = False
+      self._cond.notify()
+
+if __name__ == "__main__":
+
+  import sys
+  import json
+  import subprocess
+
+  SECONDS = 10
+  CHANNELS = (2, 4, 8, 16)
+
+  def measure(channels, seconds):
+    import sim
+    system = sim.System(channels=channels)
+    begin_cpu = time.process_time()
+    begin = time.monotonic()
+    system.start('scheduler')
+    time.sleep(seconds)
+    cpu = time.process_time() - begin_cpu
+    elapsed = time.monotonic() - begin
+    tasks = [t for t in system._runtime.stats() if t['task'].startswith('ctrl-')]
+    knobs = [s for (d, s) in system.i2c.stats().items() if d.startswith('seesaw')]
+    system.stop()
+    return { 'channels': channels,
+             'cpu_pct': 100.0 * cpu / elapsed,
+             'late_avg': sum(t['late_avg'] for t in tasks) / len(tasks),
+             'late_max': max(t['late_max'] for t in tasks),
+             'run_avg': sum(t['run_avg'] for t in tasks) / len(tasks),
+             'run_max': max(t['run_max'] for t in tasks),
+             'knob_avg': sum(k['latency_mean'] for k in knobs) / len(knobs),
+             'passes': sum(t['runs'] for t in tasks) / elapsed }
+
+  if len(sys.argv) > 1:
+    # One run per process so the channel counts don't mix
+    print(json.dumps(measure(int(sys.argv[1]), float(sys.argv[2]))))
+    sys.exit(0)
+
+  print("channels  passes/s   late avg/max (ms)   pass avg/max (ms)   knob I2C (ms)    CPU")
+  for channels in CHANNELS:
+    out = subprocess.run([sys.executable, __file__, str(channels), str(SECONDS)],
+                         capture_output=True, text=True, check=True).stdout
+    r = json.loads(out.splitlines()[-1])
+    print(f"{r['channels']:8d}  {r['passes']:8.0f}   {1000 * r['late_avg']:7.2f} /{1000 * r['late_max']:7.2f}   " +
+          f"{1000 * r['run_avg']:7.2f} /{1000 * r['run_max']:7.2f}   {1000 * r['knob_avg']:10.2f}   {r['cpu_pct']:4.1f}%")
@@ -0,0 +1,60 @@
+import logging
+import threading
+from collections import namedtuple
+
+"""
+Channel settings
+
+The user settings of a controller channel (setpoint, window, Tilt color)
+as typed values instead of configparser strings.  The current settings
+are an immutable Snapshot; readers take a reference to it (one attribute
+read, no lock) and use its plain floats for as long as they like.  A
+writer (the knob, a future API) builds a new snapshot with update(),
+which is swapped in atomically with a bumped version, and the listeners
+are told about the change.
+
+The config file section is only parsed once, at startup, and only
+written back by the thread which saves the config file (write()), so the
+controllers never touch configparser objects another thread is writing.
+
+"""
+
+logger = logging.getLogger('tiltpirelay.settings')
+
+FIELDS = { 'setpoint': float, 'window': float, 'tiltcolor': str }
+
+Snapshot = namedtuple('Snapshot', ['version'] + list(FIELDS))
+
+class ChannelSettings:
+
+  def __init__(self, section, name=None):
+    self.name = name or section.name
+    self._lock = threading.Lock()
+    self._listeners = []
+    self.current = Snapshot(0, *(kind(section[field]) for (field, kind) in FIELDS.items()))
+
+  def update(self, **changes):
+    """ Publish a new snapshot with the changes; returns it """
+    with self._lock:
+      old = self.current
+      values = { field: FIELDS[field](value) for (field, value) in changes.items() }
+      new = old._replace(version=old.version + 1, **values)
+      self.current = new
+    logger.debug(f"{self.name} settings v{new.version}: {values}")
+    for fn in list(self._listeners):
+      try:
+        fn(old, new)
+      except Exception as e:
+        logger.error(f"{self.name} settings listener failed: {e}")
+    return new
+
+  def listen(self, fn):
+    """ Call fn(old, new) after every update (in the updating thread) """
+    self._listeners.append(fn)
+
+  def write(self, section):
+    """ Store the current settings in the config section """
+    current = self.current
+    for field in FIELDS:
+      section[field] = str(getattr(current, field))
+    return current.version
@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import types
+import random
+import tempfile
+import threading
+import configparser
+
+"""
+Simulated hardware
+
+Stand-ins for the Raspberry Pi hardware modules (RPi.GPIO, board,
+adafruit_seesaw, rpi_lcd, adafruit_ble) and for the DS18B20 probes, so
+the controllers, displays and probe sampling can be run and benchmarked
+on a machine without the hardware.  I2C transactions and probe
+conversions take about as long as they do on a Pi.  Nothing here is used
+when running on the Pi.
+
+install() puts the fake modules in sys.modules; it has to be called
+before the modules using them are imported.  System builds a complete
+set of N controller channels plus the system display and Tilt scanner,
+wired up as in main.py, and runs them with either runtime.  With
+interrupts the knobs are read on (never arriving) seesaw interrupts
+instead of being polled.
+
+"""
+
+I2C_OP_S = 0.0005
+LCD_WRITE_S = 0.0006
+PROBE_C = 20.0
+
+def _module(name, **attrs):
+  m = types.ModuleType(name)
+  m.__dict__.update(attrs)
+  sys.modules[name] = m
+  return m
+
+def install():
+  """ Put the fake hardware modules in sys.modules """
+  if 'sim_installed' in sys.modules:
+    return
+  _module('sim_installed')
+
+  # RPi.GPIO
+  gpio = _module('RPi.GPIO', BCM=11, OUT=0, IN=1, LOW=0, HIGH=1, PUD_UP=22, FALLING=32,
+                 _mode=[None])
+  gpio.getmode = lambda: gpio._mode[0]
+  gpio.setmode = lambda mode: gpio._mode.__setitem__(0, mode)
+  gpio.setup = lambda *a, **k: None
+  gpio.output = lambda *a, **k: None
+  gpio.input = lambda pin: gpio.HIGH
+  gpio.add_event_detect = lambda *a, **k: None
+  gpio.remove_event_detect = lambda *a, **k: None
+  gpio.cleanup = lambda *a, **k: None
+  _module('RPi', GPIO=gpio)
+
+  _module('board', I2C=lambda: object())
+
+  # adafruit_seesaw
+  class Seesaw:
+    INPUT_PULLUP = 2
+    def __init__(self, i2c, addr):
+      self.addr = addr
+      time.sleep(I2C_OP_S)
+    def pin_mode(self, pin, mode):
+      time.sleep(I2C_OP_S)
+    def set_GPIO_interrupts(self, pins, enabled):
+      time.sleep(I2C_OP_S)
+    def enable_encoder_interrupt(self, encoder=0):
+      time.sleep(I2C_OP_S)
+    def get_GPIO_interrupt_flag(self, delay=0.008):
+      time.sleep(I2C_OP_S)
+      return 0
+
+  class IncrementalEncoder:
+    def __init__(self, ss):
+      self._position = 0
+    @property
+    def position(self):
+      time.sleep(I2C_OP_S)
+      return self._position
+
+  class DigitalIO:
+    def __init__(self, ss, pin):
+      pass
+    @property
+    def value(self):
+      time.sleep(I2C_OP_S)
+      return True   # pulled up; not pressed
+
+  class NeoPixel:
+    def __init__(self, ss, pin, n):
+      self.brightness = 1.0
+    def fill(self, color):
+      time.sleep(I2C_OP_S)
+
+  _module('adafruit_seesaw',
+          seesaw=_module('adafruit_seesaw.seesaw', Seesaw=Seesaw),
+          rotaryio=_module('adafruit_seesaw.rotaryio', IncrementalEncoder=IncrementalEncoder),
+          digitalio=_module('adafruit_seesaw.digitalio', DigitalIO=DigitalIO),
+          neopixel=_module('adafruit_seesaw.neopixel', NeoPixel=NeoPixel))
+
+  # rpi_lcd
+  class LCD:
+    def __init__(self, address=0x27, bus=1, width=20, rows=4, backlight=True):
+      self.width = width
+      for _ in range(6):
+        self.write(0)
+    def write(self, byte, mode=0):
+      time.sleep(LCD_WRITE_S)
+    def text(self, text, line, align='left'):
+      for _ in range(self.width + 1):
+        self.write(0)
+    def backlight(self, turn_on=True):
+      self.write(0)
+
+  _module('rpi_lcd', LCD=LCD)
+
+  # adafruit_ble
+  class BLERadio:
+    def start_scan(self, timeout=None):
+      time.sleep(timeout)
+      return iter(())
+    def stop_scan(self):
+      pass
+
+  _module('adafruit_ble', BLERadio=BLERadio)
+
+def make_w1(root, buses, per_bus=1):
+  """ sysfs like one-wire tree with per_bus probes on each bus """
+  for b in range(1, buses + 1):
+    bus = os.path.join(root, f"w1_bus_master{b}")
+    os.makedirs(bus, exist_ok=True)
+    for p in range(per_bus):
+      dev = os.path.join(bus, f"28-{b:04x}{p:08x}")
+      os.makedirs(dev, exist_ok=True)
+      with open(os.path.join(dev, 'temperature'), 'w') as f:
+        f.write(f"{int(PROBE_C * 1000)}\n")
+      with open(os.path.join(dev, 'resolution'), 'w') as f:
+        f.write("12\n")
+  return root + '/'
+
+def registry(root):
+  """ W1Registry whose reads take a conversion time and drift a little """
+  from w1 import W1Registry, CONV_TIME_S
+
+  class SimW1Registry(W1Registry):
+    def read(self, bus, rom=None):
+      raw = super().read(bus, rom)
+      if raw is None:
+        return None
+      time.sleep(CONV_TIME_S.get(self.resolution(bus, rom), 0.75))
+      return str(int(raw) + random.randint(-250, 250))
+
+  return SimW1Registry(root)
+
+class System:
+  """ N controller channels, the system display and Tilt scanner on fake hardware """
+
+  def __init__(self, channels=2, interrupts=False):
+    install()
+    import logging
+    from temp import Temp, TempSweep
+    from i2cbus import I2CBus
+    from ingest import Ingest
+    from controller import Controller
+    from settings import ChannelSettings
+    from system import System as SystemDisplay
+    from tilt import TiltScanner
+    logging.getLogger('tiltpirelay').setLevel(logging.WARNING)
+
+    self._dir = tempfile.TemporaryDirectory()
+    self.w1 = registry(make_w1(self._dir.name, channels + 3))
+    self.i2c = I2CBus(1)
+    self._i2c_thread = threading.Thread(target=self.i2c.bus_thread, daemon=True)
+    self._i2c_thread.start()
+
+    self.config = configparser.ConfigParser()
+    self.config['DEFAULT'] = { 'setpoint': '65.0', 'tiltcolor': 'ORANGE',
+                               'window': '0.2', 'updated': 'False' }
+    self.ingest = Ingest()
+    self.reader = self.ingest.reader('sim')
+    self.tilt = TiltScanner(self.ingest)
+
+    probes = []
+    self.controllers = []
+    for i in range(1, channels + 1):
+      self.config[f"port{i}"] = {}
+      t = Temp(f"temp{i}", f"w1_bus_master{i}", w1=self.w1)
+      probes.append((t, self.ingest.source(f"temp{i}"), True))
+      self.controllers.append(Controller(f"ctrl-{i}", ChannelSettings(self.config[f"port{i}"]),
+                                         100 + 2 * i, 101 + 2 * i,
+                                         t, self.tilt, 0x20 + i, 0x40 + i, self.ingest,
+                                         200 + i if interrupts else None, self.i2c))
+    extra = [Temp(name, f"w1_bus_master{channels + n}", w1=self.w1)
+             for (n, name) in enumerate(('ambient', 'glycol', 'internal'), 1)]
+    probes += [(t, self.ingest.source(t.name)) for t in extra]
+    self.sysinfo = SystemDisplay(0x10, extra[0], extra[1], self.i2c)
+    self.sweep = TempSweep(probes)
+    self._runtime = None
+    self._thread = None
+
+  def main_step(self):
+    """ main.py's loop: sample the probes (and drop what they report) """
+    delay = self.sweep.step()
+    self.reader.drain()
+    return delay
+
+  def start(self, mode):
+    """ Start everything with the 'scheduler' or 'asyncio' runtime; returns the thread count """
+    if mode == 'asyncio':
+      from runtime import Runtime
+      self._runtime = Runtime()
+    else:
+      from scheduler import Scheduler
+      self._runtime = Scheduler()
+    for c in self.controllers:
+      self._runtime.every(c._name, c.step, c)
+    self._runtime.every('system', self.sysinfo.step)
+    self._runtime.every('tilt', self.tilt.step)
+    self._runtime.every('w1', self.w1.step)
+    self._runtime.every('main', self.main_step)
+    self._thread = threading.Thread(target=self._runtime.run, daemon=True)
+    self._thread.start()
+    time.sleep(1.0)
+    return threading.active_count()
+
+  def sweeps(self):
+    return self.sweep.sweeps
+
+  def stop(self):
+    if self._runtime:
+      self._runtime.end()
+      self._thread.join()
+    for c in self.controllers:
+      c.end()
+    self.sysinfo.end()
+    self.tilt.end()
+    self.w1.end()
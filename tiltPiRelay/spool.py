@@ -0,0 +1,104 @@
+import time
+import sqlite3
+import logging
+import threading
+
+"""
+Upload spool class
+
+Append-only, crash-safe store for feed values waiting to be uploaded.
+Backed by SQLite in WAL mode so data survives a restart or power loss
+and doesn't have to sit in RAM while the network is down.
+
+Rows are read back in the order they were written and removed once they
+have been acknowledged.  Retention limits (row count and age) keep the
+file from growing without bound during long outages; the oldest rows are
+discarded first.
+
+"""
+
+logger = logging.getLogger('tiltpirelay.spool')
+
+DEFAULT_MAX_ROWS = 500000
+DEFAULT_MAX_AGE_S = 30 * 24 * 3600
+
+class Spool:
+
+  def __init__(self, path, max_rows=DEFAULT_MAX_ROWS, max_age=DEFAULT_MAX_AGE_S):
+    self._path = path
+    self._max_rows = max_rows
+    self._max_age = max_age
+    self._lock = threading.Lock()
+    self._dropped = 0
+
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute('CREATE TABLE IF NOT EXISTS spool ('
+                     'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'ts REAL NOT NULL, '
+                     'feed TEXT NOT NULL, '
+                     'value)')
+    self._db.execute('CREATE INDEX IF NOT EXISTS spool_feed ON spool (feed, id)')
+    self._db.commit()
+    logger.info(f"Spool {path} opened with {self.count()} pending values")
+
+  def append(self, rows):
+    """ Add a list of (timestamp, feedkey, value) rows """
+    if not rows:
+      return
+    with self._lock:
+      with self._db:
+        self._db.executemany('INSERT INTO spool (ts, feed, value) VALUES (?, ?, ?)', rows)
+
+  def peek(self, limit, feed=None):
+    """
+    Return up to limit of the oldest (id, timestamp, feedkey, value) rows,
+    optionally only those for one feed
+    """
+    with self._lock:
+      if feed is None:
+        return self._db.execute('SELECT id, ts, feed, value FROM spool ORDER BY id LIMIT ?',
+                                (limit,)).fetchall()
+      return self._db.execute('SELECT id, ts, feed, value FROM spool WHERE feed = ? '
+                              'ORDER BY id LIMIT ?', (feed, limit)).fetchall()
+
+  def feeds(self):
+    """ Return the feeds which have spooled rows """
+    with self._lock:
+      return [r[0] for r in self._db.execute('SELECT DISTINCT feed FROM spool')]
+
+  def ack(self, ids):
+    """ Remove rows which have been uploaded """
+    if not ids:
+      return
+    with self._lock:
+      with self._db:
+        self._db.executemany('DELETE FROM spool WHERE id = ?', [(i,) for i in ids])
+
+  def count(self):
+    with self._lock:
+      return self._db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+  def dropped(self):
+    return self._dropped
+
+  def prune(self):
+    """ Apply retention limits; returns the number of rows removed """
+    removed = 0
+    with self._lock:
+      with self._db:
+        cur = self._db.execute('DELETE FROM spool WHERE ts < ?',
+                               (time.time() - self._max_age,))
+        removed += cur.rowcount
+        cur = self._db.execute('DELETE FROM spool WHERE id <= '
+                               '(SELECT MAX(id) FROM spool) - ?', (self._max_rows,))
+        removed += cur.rowcount
+    if removed:
+      self._dropped += removed
+      logger.warning(f"Spool retention dropped {removed} values ({self._dropped} total)")
+    return removed
+
+  def close(self):
+    with self._lock:
+      self._db.close()
@@ -5,14 +5,12 @@ import os
 import logging
 #import errno
 import temp
-import time
 #import configparser
 #import RPi.GPIO as GPIO
 #from distutils.util import strtobool
 #from glob import glob
-from rpi_lcd import LCD
 #from time import sleep,now
-import board
+from i2cbus import LCDProxy, shared
 #from adafruit_seesaw import seesaw, rotaryio, digitalio, neopixel
 
 """
@@ -25,33 +23,38 @@ System display class
  |Glycol:   32.4F |
   ----------------
 
+The display is written through the shared I2C bus arbiter (i2cbus.py).
+
 """
 
 logger = logging.getLogger('tiltpirelay.system')
 
+UPDATE_S = 1.0
+
 class System:
   
-  def __init__(self, display_addr, ambient_tempdev, glycol_tempdev):
+  def __init__(self, display_addr, ambient_tempdev, glycol_tempdev, i2c=None):
 
     self._ambient = ambient_tempdev
     self._glycol = glycol_tempdev
     self._run = True;
 
     try:
-      self._lcd = LCD(address=display_addr, bus=1, width=16, rows=2)
+      self._lcd = LCDProxy(i2c or shared(), display_addr, width=16, rows=2)
     except OSError as e:
       logger.warning("LCD [0x{:x}] not available".format(display_addr))
       self._lcd = None
 
-  def system_thread(self):
-    logger.debug("Begin system thread");
-    while self._run:
-      self.update_display()
-      time.sleep(1.00)
+  def step(self):
+    """ Refresh the display; returns the seconds until the next refresh """
+    self.update_display()
+    return UPDATE_S
 
+  def shutdown(self):
     if self._lcd:
       self._lcd.text("SYSTEM", 1, align='center')
       self._lcd.text("OFF", 2, align='center')
+      self._lcd.flush()
 
   def update_display(self):
     lines = ['']*2
@@ -1,84 +1,281 @@
 #!/bin/env python3
 
 import time
-import sys
 import logging
-import statistics
 import RPi.GPIO as GPIO
-from datetime import datetime, timezone
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from sample import Sample, Schema
+from w1 import registry, RESOLUTIONS, CONV_TIME_S
+from filters import FilterChain, DEFAULT_CHAIN
 
 """
 Temp reader class
 
-Handles reading temp from one-wire bus temp sensor.  Assumes
-a single temp sensor on the bus.
+Handles reading temp from one-wire bus temp sensor.  A sensor is either
+the only (first) one on its bus, or addressed by its ROM ID so any number
+of them can share a bus.  A sensor given by ROM ID alone is looked for on
+every bus.  The sensors are found and read through the shared one-wire
+registry (see w1.py).  Every reading goes through a filter chain (see
+filters.py) before it is used or reported; dropped readings leave the
+last value in place.
+
+Reading 'temperature' from sysfs blocks for a whole DS18B20 conversion
+(~750ms at 12 bits), so reading the probes one after the other takes
+several seconds.  TempSweep reads a set of probes together: each bus gets
+its own worker which starts the conversion on all the sensors on that bus
+at once with the w1 'therm_bulk_read' trigger (when the kernel supports
+it) and then collects the results, so a sweep of every bus takes about
+one conversion time however many sensors there are.  Without the bulk
+trigger the sensors on one bus are converted one after another.  The time
+each sweep took is kept for reporting.
+
+Each probe in a sweep has its own schedule.  Probes that drive a relay
+are run at 12 bits (0.1F) and the others at 10 bits (0.45F), which takes
+a quarter of the conversion time.  A probe is read again after about the
+time its temperature takes to change by one step of its resolution (from
+the measured rate of change), between one conversion time and 5 seconds
+for the control probes or 60 seconds for the others.  So a fast moving
+control probe gets most of the bus time and a steady ambient probe very
+little.  TempSweep.schedule() reports each probe's resolution, period and
+measured conversion latency, and TempSweep.filter_stats() how many of its
+readings each filter stage dropped.
 
 """
 
 logger = logging.getLogger('tiltpirelay.temp')
-INTERVALS_MEDIAN_SIZE = 5
+
+DEFAULT_PERIOD_S = 1.0
+# Smallest step each resolution can resolve, in F
+STEP_F = { b: 0.5 / (1 << (b - 9)) * 9 / 5 for b in RESOLUTIONS }
+# Probes driving a relay need to resolve a fraction of the control window;
+# the others are only displayed and logged
+CONTROL_PRECISION_F = 0.125
+MONITOR_PRECISION_F = 0.5
+CONTROL_MAX_PERIOD_S = 5.0
+MONITOR_MAX_PERIOD_S = 60.0
+RESOLUTION_CHECK_S = 60.0
+RATE_ALPHA = 0.3
 
 class Temp:
   
-  def __init__(self, name, w1_bus):
+  def __init__(self, name, w1_bus=None, rom=None, w1=None, filters=DEFAULT_CHAIN):
     self._bus = w1_bus
+    self._fixed = w1_bus is not None
+    self._rom = rom
     self._name = name
-    self._file = None
+    self.period = DEFAULT_PERIOD_S
+    self._w1 = w1 or registry()
+    if rom:
+      self._w1.claim(rom)
+    self._schema = Schema(name, ('temp',))
+    self._filter = FilterChain(filters, name)
     self._last_temp  = None
-    self._last_time  = None
-    self._interval = None
-    self._intervals = []
 
     self.get_temp()
 
-  def get_interval(self):
-    if self._interval:
-      return self._interval
-    if (len(self._intervals)):
-      median = statistics.median(self._intervals)
-      if len(self._intervals) >= INTERVALS_MEDIAN_SIZE:
-          self._interval = median
-      return median
-    return sys.maxsize
+  @property
+  def bus(self):
+    if self._bus is None and self._rom:
+      self._bus = self._w1.find(self._rom)
+    return self._bus
 
-  def get_temp(self, q = None):
-    now = time.time()
-    if self._last_time and len(self._intervals) < INTERVALS_MEDIAN_SIZE:
-      self._intervals.append(now - self._last_time)
-    self._last_time = now
-    if self._file is None:
-      try:
-        self._file = glob('/sys/bus/w1/devices/' + self._bus + '/28-*/temperature')[0]
-      except IndexError as e:
-        logger.warning("No temp sensor found on bus {}".format(self._bus))
-        self._last_temp  = None
-        return
+  @property
+  def name(self):
+    return self._name
 
-    try:
-      f = open(self._file, 'r')
-    except OSError as e:
-      logger.warning("Temp sensor removed on bus {}".format(self._bus))
-      self._file = None
+  @property
+  def rom(self):
+    return self.bus and self._w1.rom(self._bus, self._rom)
+
+  def resolution(self):
+    return self.bus and self._w1.resolution(self._bus, self._rom)
+
+  def set_resolution(self, bits):
+    return self.bus is not None and self._w1.set_resolution(self._bus, bits, self._rom)
+
+  def trigger(self):
+    """ Start a conversion on every sensor on the bus (if supported) """
+    return self.bus is not None and self._w1.trigger(self._bus)
+
+  def get_temp(self, q = None):
+    if self.bus is None:
+      self._last_temp  = None
+      return
+    raw = self._w1.read(self._bus, self._rom)
+    if raw is None:
+      if not self._fixed:
+        # May have been plugged into another bus; look for it again
+        self._bus = None
       self._last_temp  = None
       return
-
-    lines = f.readlines()
-    f.close()
 
     # value is in thousandths of degrees C; convert to decimal F
-    if (len(lines)):
-      self._last_temp = (float(lines[-1]) * 9/5000) + 32.0
-
-      if q:
-        logger.debug("Read temp on {}: {} F -> queue: {}".format(self._bus, self._last_temp, q))
-        q.put({'timestamp': datetime.now(timezone.utc).timestamp(),
-               'name': self._name,
-               'temp': self._last_temp})
-      else:
-        logger.debug("Read temp on {}: {} F (no queue)".format(self._bus, self._last_temp))
+    try:
+      value = (float(raw) * 9/5000) + 32.0
+    except ValueError:
+      logger.warning("Bad read on {}: {}".format(self._bus, raw))
+      return self._last_temp
+    value = self._filter(value)
+    if value is None:
       return self._last_temp
-    return None
+    self._last_temp = value
+
+    if q:
+      logger.debug("Read temp on {}: {} F -> queue: {}".format(self._bus, self._last_temp, q))
+      q.put(Sample(self._schema, (self._last_temp,)))
+    else:
+      logger.debug("Read temp on {}: {} F (no queue)".format(self._bus, self._last_temp))
+    return self._last_temp
 
   def last(self):
     return self._last_temp
+
+  def filter_stats(self):
+    return self._filter.stats()
+
+class Probe:
+  """ Schedule and latency of one sensor in a sweep """
+  __slots__ = ('temp', 'q', 'control', 'bits', 'target', 'applied', 'checked', 'period',
+               'due', 'rate', 'last', 'latency', 'latency_max')
+
+  def __init__(self, temp, q, control):
+    self.temp = temp
+    self.q = q
+    self.control = control
+    self.bits = None
+    self.target = None    # resolution last asked for
+    self.applied = None   # resolution the sensor reported
+    self.checked = 0.0
+    self.period = DEFAULT_PERIOD_S
+    self.due = 0.0
+    self.rate = 0.0
+    self.last = None
+    self.latency = 0.0
+    self.latency_max = 0.0
+
+class TempSweep:
+
+  def __init__(self, probes):
+    """ probes: [(Temp, queue[, control]), ...] """
+    self._probes = [Probe(p[0], p[1], p[2] if len(p) > 2 else False) for p in probes]
+    self._pool = ThreadPoolExecutor(max_workers=max(1, len(self._probes)),
+                                    thread_name_prefix='w1')
+    self.sweeps = 0
+    self.latency_last = 0.0
+    self.latency_max = 0.0
+    self.latency_total = 0.0
+
+  def sweep(self):
+    """
+    Read every probe which is due in parallel; returns the sweep time in
+    seconds (0 if nothing was due)
+    """
+    begin = time.monotonic()
+    buses = {}
+    for p in self._probes:
+      if p.due <= begin:
+        buses.setdefault(p.temp.bus, []).append(p)
+    if not buses:
+      return 0.0
+    futures = [self._pool.submit(self._read, probes) for probes in buses.values()]
+    for f in futures:
+      try:
+        f.result()
+      except Exception as e:
+        logger.error(f"Temp read failed: {e}")
+    latency = time.monotonic() - begin
+
+    self.sweeps += 1
+    self.latency_last = latency
+    self.latency_max = max(self.latency_max, latency)
+    self.latency_total += latency
+    logger.debug(f"Temp sweep {self.sweeps} of {sum(len(b) for b in buses.values())} probes took {latency * 1000:.0f}ms")
+    return latency
+
+  def step(self):
+    """ Sweep the probes which are due; returns the seconds until the next one is """
+    self.sweep()
+    if not self._probes:
+      return DEFAULT_PERIOD_S
+    return max(0.0, min(p.due for p in self._probes) - time.monotonic())
+
+  def _read(self, probes):
+    """ One bulk conversion for the bus, then read each sensor on it """
+    begin = time.monotonic()
+    probes[0].temp.trigger()
+    for p in probes:
+      value = p.temp.get_temp(p.q)
+      now = time.monotonic()
+      p.latency = now - begin
+      p.latency_max = max(p.latency_max, p.latency)
+      self._schedule(p, value, now)
+
+  def _schedule(self, p, value, now):
+    """
+    Pick the resolution and sampling period of a probe: as coarse as its
+    job allows (relay control vs monitoring) and sampled about as often as
+    it takes the temperature to move by one step of that resolution
+    """
+    precision = CONTROL_PRECISION_F if p.control else MONITOR_PRECISION_F
+    bits = next((b for b in RESOLUTIONS if STEP_F[b] <= precision), RESOLUTIONS[-1])
+    if value is None:
+      p.target = p.applied = None
+      p.period = DEFAULT_PERIOD_S
+    else:
+      if bits != p.target or (now - p.checked) > RESOLUTION_CHECK_S:
+        # Sensors come back at their power-on resolution after a replug.
+        # A failed write (sysfs not writable) is only retried on the next
+        # check, not on every read.
+        p.checked = now
+        p.target = bits
+        if p.temp.resolution() != bits and not p.temp.set_resolution(bits):
+          bits = p.temp.resolution() or RESOLUTIONS[-1]
+        p.applied = bits
+      else:
+        bits = p.applied
+
+      longest = CONTROL_MAX_PERIOD_S if p.control else MONITOR_MAX_PERIOD_S
+      if p.last is None:
+        # No rate yet; read again as soon as possible
+        period = 0.0
+      else:
+        (t0, v0) = p.last
+        rate = abs(value - v0) / max(now - t0, 0.001)
+        p.rate += RATE_ALPHA * (rate - p.rate)
+        period = STEP_F[bits] / p.rate if p.rate > 0 else longest
+      p.last = (now, value)
+      p.period = min(longest, max(CONV_TIME_S[bits], period))
+
+    if bits != p.bits:
+      logger.info(f"Temp {p.temp.name}: {bits} bit resolution, read every {p.period:.2f}s, " +
+                  f"conversion took {p.latency:.3f}s")
+    p.bits = bits
+    p.due = now + p.period
+    p.temp.period = p.period
+
+  def schedule(self):
+    """ Current resolution, period and conversion latency of every probe """
+    now = time.monotonic()
+    return [ { 'name': p.temp.name,
+               'bus': p.temp.bus,
+               'rom': p.temp.rom,
+               'control': p.control,
+               'resolution': p.bits,
+               'period': p.period,
+               'due': max(0.0, p.due - now),
+               'rate': p.rate,
+               'latency': p.latency,
+               'latency_max': p.latency_max } for p in self._probes ]
+
+  def filter_stats(self):
+    """ Per stage readings seen and dropped, by probe """
+    return { p.temp.name: p.temp.filter_stats() for p in self._probes }
+
+  def stats(self):
+    return { 'sweeps': self.sweeps,
+             'latency': self.latency_last,
+             'latency_max': self.latency_max,
+             'latency_mean': self.latency_total / self.sweeps if self.sweeps else 0.0 }
+
+  def end(self):
+    self._pool.shutdown(wait=True)
@@ -20,8 +20,8 @@ if sys.version_info[0] < 3 or sys.version_info[1] < 8:
 from adafruit_ble import BLERadio
 
 from struct import unpack
-from datetime import datetime, timedelta, timezone
-from queue import SimpleQueue
+from sample import Sample, Schema
+from ringq import RingQueue
 
 logger = logging.getLogger('tiltpirelay.tilt')
 
@@ -30,6 +30,7 @@ APPLE_COMPANY_ID = 0x004C
 IBEACON_TYPE = 0x02
 
 BLE_SCAN_TIME = 5.0
+SCAN_PAUSE_S = 0.1
 
 TILTCOLOR = {
     'A495BB10C5B14B44B5121370F02D74DE': 'RED',
@@ -45,11 +46,16 @@ TILTCOLOR = {
 
 class TiltScanner:
   
-  def __init__(self):
+  def __init__(self, channel=None):
     self.ble = BLERadio()
     #self.ble._adapter.ble_backend = "bleak"
     self.last = { c: None for c in TILTCOLOR.values() }
-    self.q = { c: SimpleQueue() for c in TILTCOLOR.values() }
+    self._schema = { c: Schema(f"tilt-{c}", ('temp', 'sg', 'tx', 'rssi'))
+                     for c in TILTCOLOR.values() }
+    if channel:
+      self.q = { c: channel.source(f"tilt-{c}") for c in TILTCOLOR.values() }
+    else:
+      self.q = { c: RingQueue(name=f"tilt-{c}") for c in TILTCOLOR.values() }
     self._run = True;
 
   def HandleBleAdv(self, advertisement_data):
@@ -62,12 +68,8 @@ class TiltScanner:
           if uuid in TILTCOLOR:
             color = TILTCOLOR[uuid]
             (temp,sg,tx) = unpack('>HHB', bytes(mfgdata[20:25]))
-            datapoint = {'timestamp': datetime.now(timezone.utc).timestamp(),
-                         'name': f"tilt-{color}",
-                         'temp': temp,
-                         'sg': sg / 1000.0,
-                         'tx': tx,
-                         'rssi': advertisement_data.rssi }
+            datapoint = Sample(self._schema[color],
+                               (temp, sg / 1000.0, tx, advertisement_data.rssi))
             self.last[color] = datapoint
             self.q[color].put(datapoint)
             logger.debug(f"Added tilt record: {datapoint} size: {self.q[color].qsize()}")
@@ -80,12 +82,20 @@ class TiltScanner:
   def get_queue(self, color):
     return  self.q[color]
 
+  def scan(self):
+    """ One BLE scan (blocks for BLE_SCAN_TIME) """
+    for advertisement in self.ble.start_scan(timeout=BLE_SCAN_TIME):
+      self.HandleBleAdv(advertisement)
+    self.ble.stop_scan();
+
+  def step(self):
+    """ One scan; returns the seconds until the next one """
+    self.scan()
+    return SCAN_PAUSE_S
+
   def control_thread(self):
     while self._run:
-      for advertisement in self.ble.start_scan(timeout=BLE_SCAN_TIME):
-        self.HandleBleAdv(advertisement)
-      self.ble.stop_scan();
-      time.sleep(0.1)
+      time.sleep(self.step())
 
   def end(self):
     self._run = False
@@ -0,0 +1,417 @@
+import os
+import time
+import shutil
+import struct
+import logging
+import threading
+from datetime import datetime, timezone
+from aggregate import Window
+
+"""
+Local time series store
+
+Keeps every sensor, Tilt and controller value on local storage as a
+second sink next to io.adafruit.com.
+
+Layout
+  <root>/<level>/<partition>/<feed>.tsc
+
+Each feed has three levels:
+  raw - every sample (one partition per day)
+  1m  - 1 minute rollups (one partition per month)
+  1h  - 1 hour rollups (one partition per year)
+
+Rollups are computed while the samples arrive and store the mean, min,
+max and sample count of each window, so queries over long ranges read a
+small number of points rather than the raw data.  The window in progress
+is written when the store is closed; if the same window is continued
+after a restart the query merges the two points.
+
+Files are append-only sequences of compressed column chunks.  Each chunk
+has a small header (payload length, point count, first and last time) so
+range queries skip chunks (and whole partitions) outside the range
+without decoding them.  A truncated chunk at the end of a file (power
+loss while writing) is ignored.
+
+Chunk encoding (Gorilla style):
+  timestamps - milliseconds, delta-of-delta with variable length buckets
+  values     - float64 XOR'd with the previous value of the column,
+               storing only the meaningful bits
+
+"""
+
+logger = logging.getLogger('tiltpirelay.tsdb')
+
+LEVELS = { 'raw': 0, '1m': 60, '1h': 3600 }
+PARTITION_FORMAT = { 'raw': '%Y-%m-%d', '1m': '%Y-%m', '1h': '%Y' }
+ROLLUP_COLUMNS = ['mean', 'min', 'max', 'count']
+
+CHUNK_POINTS = 512
+CHUNK_FLUSH_S = 300
+CHUNK_HEADER = struct.Struct('<IHBqq')   # length, count, columns, first ms, last ms
+
+DEFAULT_RETENTION_DAYS = { 'raw': 90, '1m': 730, '1h': 0 }  # 0 keeps forever
+
+class BitWriter:
+
+  def __init__(self):
+    self._acc = 0
+    self._n = 0
+
+  def write(self, value, bits):
+    self._acc = (self._acc << bits) | (value & ((1 << bits) - 1))
+    self._n += bits
+
+  def getvalue(self):
+    pad = (-self._n) % 8
+    return (self._acc << pad).to_bytes((self._n + pad) // 8, 'big')
+
+class BitReader:
+
+  def __init__(self, data):
+    self._acc = int.from_bytes(data, 'big')
+    self._left = len(data) * 8
+
+  def read(self, bits):
+    self._left -= bits
+    return (self._acc >> self._left) & ((1 << bits) - 1)
+
+# delta-of-delta buckets: (prefix, prefix bits, value bits)
+DOD_BUCKETS = [ (0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b11110, 5, 32) ]
+
+def _float_bits(v):
+  return struct.unpack('<Q', struct.pack('<d', v))[0]
+
+def _bits_float(b):
+  return struct.unpack('<d', struct.pack('<Q', b))[0]
+
+def encode_chunk(points):
+  """ Encode [(ms, (v, ...)), ...] into a chunk (header + payload) """
+  ncols = len(points[0][1])
+  w = BitWriter()
+  prev_t = points[0][0]
+  prev_delta = 0
+  prev = [0] * ncols
+  window = [(65, 0)] * ncols  # (leading, trailing) of the previous XOR
+
+  for (i, (t, values)) in enumerate(points):
+    if i:
+      delta = t - prev_t
+      dod = delta - prev_delta
+      if dod == 0:
+        w.write(0, 1)
+      else:
+        for (prefix, pbits, vbits) in DOD_BUCKETS:
+          if -(1 << (vbits - 1)) <= dod < (1 << (vbits - 1)):
+            w.write(prefix, pbits)
+            w.write(dod, vbits)
+            break
+        else:
+          w.write(0b11111, 5)
+          w.write(dod, 64)
+      prev_t = t
+      prev_delta = delta
+
+    for c in range(ncols):
+      b = _float_bits(float(values[c]))
+      if not i:
+        w.write(b, 64)
+        prev[c] = b
+        continue
+      x = b ^ prev[c]
+      prev[c] = b
+      if x == 0:
+        w.write(0, 1)
+        continue
+      leading = min(31, 64 - x.bit_length())
+      trailing = (x & -x).bit_length() - 1
+      (pl, pt) = window[c]
+      if leading >= pl and trailing >= pt:
+        w.write(0b10, 2)
+        w.write(x >> pt, 64 - pl - pt)
+      else:
+        w.write(0b11, 2)
+        w.write(leading, 5)
+        w.write(64 - leading - trailing - 1, 6)
+        w.write(x >> trailing, 64 - leading - trailing)
+        window[c] = (leading, trailing)
+
+  payload = w.getvalue()
+  return CHUNK_HEADER.pack(len(payload), len(points), ncols,
+                           points[0][0], points[-1][0]) + payload
+
+def decode_chunk(count, ncols, first, payload):
+  """ Decode a chunk payload back into [(ms, (v, ...)), ...] """
+  r = BitReader(payload)
+  points = []
+  t = first
+  delta = 0
+  prev = [0] * ncols
+  window = [(0, 0)] * ncols
+
+  for i in range(count):
+    if i:
+      if r.read(1):
+        for (prefix, pbits, vbits) in DOD_BUCKETS:
+          if r.read(1) == 0:
+            dod = r.read(vbits)
+            if dod >= (1 << (vbits - 1)):
+              dod -= 1 << vbits
+            break
+        else:
+          dod = r.read(64)
+          if dod >= (1 << 63):
+            dod -= 1 << 64
+        delta += dod
+      t += delta
+
+    values = []
+    for c in range(ncols):
+      if not i:
+        prev[c] = r.read(64)
+      elif r.read(1):
+        if r.read(1):
+          leading = r.read(5)
+          length = r.read(6) + 1
+          window[c] = (leading, 64 - leading - length)
+        (pl, pt) = window[c]
+        prev[c] ^= r.read(64 - pl - pt) << pt
+      values.append(_bits_float(prev[c]))
+    points.append((t, tuple(values)))
+  return points
+
+def read_chunks(path, start_ms, end_ms):
+  """ Yield the points of every chunk in a file which overlaps [start_ms, end_ms] """
+  try:
+    with open(path, 'rb') as f:
+      data = f.read()
+  except FileNotFoundError:
+    return
+  pos = 0
+  while pos + CHUNK_HEADER.size <= len(data):
+    (length, count, ncols, first, last) = CHUNK_HEADER.unpack_from(data, pos)
+    pos += CHUNK_HEADER.size
+    if pos + length > len(data):
+      logger.warning(f"Ignoring truncated chunk at end of {path}")
+      return
+    if last >= start_ms and first <= end_ms:
+      for p in decode_chunk(count, ncols, first, data[pos:pos + length]):
+        if start_ms <= p[0] <= end_ms:
+          yield p
+    pos += length
+
+def merge_rollups(points):
+  """
+  Combine rollup points with the same window start (time ordered).  A
+  window in progress at shutdown is written as a partial rollup, and the
+  rest of it again after a restart.
+  """
+  merged = []
+  for (t, (mean, lo, hi, count)) in points:
+    if merged and merged[-1][0] == t:
+      (pmean, plo, phi, pcount) = merged[-1][1]
+      total = pcount + count
+      merged[-1] = (t, ((pmean * pcount + mean * count) / total,
+                        min(plo, lo), max(phi, hi), total))
+    else:
+      merged.append((t, (mean, lo, hi, count)))
+  return merged
+
+class Series:
+  """ Write buffer of one level of one feed """
+
+  def __init__(self, store, feed, level):
+    self._store = store
+    self.feed = feed
+    self.level = level
+    self.points = []
+    self.partition = None
+    self.opened = 0
+    self.window = None   # rollup window in progress
+
+  def append(self, ms, values):
+    partition = self._store.partition(self.level, ms / 1000.0)
+    if self.points and (partition != self.partition or len(self.points) >= CHUNK_POINTS):
+      self.flush()
+    if not self.points:
+      self.partition = partition
+      self.opened = time.monotonic()
+    self.points.append((ms, values))
+
+  def flush(self):
+    if not self.points:
+      return
+    path = self._store.path(self.level, self.partition, self.feed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+      f.write(encode_chunk(self.points))
+    self.points = []
+
+class Store:
+
+  def __init__(self, root, retention=DEFAULT_RETENTION_DAYS):
+    self._root = root
+    self._retention = dict(DEFAULT_RETENTION_DAYS, **retention)
+    self._lock = threading.Lock()
+    self._series = {}  # (feed, level) -> Series
+    self._last = {}    # feed -> timestamp of the newest sample
+    os.makedirs(root, exist_ok=True)
+
+  def partition(self, level, ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime(PARTITION_FORMAT[level])
+
+  def path(self, level, partition, feed):
+    return os.path.join(self._root, level, partition, feed + '.tsc')
+
+  def _get_series(self, feed, level):
+    s = self._series.get((feed, level))
+    if s is None:
+      s = self._series[(feed, level)] = Series(self, feed, level)
+    return s
+
+  def append(self, feed, ts, value):
+    """ Add a raw sample and update the rollups """
+    value = float(value)
+    with self._lock:
+      self._last[feed] = ts
+      self._get_series(feed, 'raw').append(int(ts * 1000), (value,))
+      for (level, period) in LEVELS.items():
+        if not period:
+          continue
+        s = self._get_series(feed, level)
+        start = ts - (ts % period)
+        if s.window is None:
+          s.window = Window(start, value)
+        elif s.window.start == start:
+          s.window.add(value)
+        else:
+          self._close_window(s)
+          s.window = Window(start, value)
+
+  def _close_window(self, s):
+    w = s.window
+    s.append(int(w.start * 1000), (w.mean(), w.min, w.max, float(w.count)))
+    s.window = None
+
+  def flush(self, max_age=0):
+    """ Write buffered chunks which have been open at least max_age seconds """
+    now = time.monotonic()
+    with self._lock:
+      for s in self._series.values():
+        if s.points and (now - s.opened) >= max_age:
+          s.flush()
+
+  def close(self):
+    with self._lock:
+      for s in self._series.values():
+        if s.window is not None:
+          self._close_window(s)
+        s.flush()
+
+  def last(self, feed):
+    """ Timestamp of the newest sample added to a feed since startup (or None) """
+    with self._lock:
+      return self._last.get(feed)
+
+  def feeds(self):
+    feeds = set()
+    with self._lock:
+      feeds.update(f for (f, _) in self._series)
+    raw = os.path.join(self._root, 'raw')
+    if os.path.isdir(raw):
+      for part in os.listdir(raw):
+        feeds.update(os.path.splitext(f)[0] for f in os.listdir(os.path.join(raw, part)))
+    return sorted(feeds)
+
+  def query(self, feed, start, end, level='raw'):
+    """
+    Return the points of a feed between start and end (epoch seconds)
+    as (timestamp, value) for raw data or (timestamp, mean, min, max,
+    count) for rollups, in time order.
+    """
+    start_ms = int(start * 1000)
+    end_ms = int(end * 1000)
+    points = []
+    # Partition names sort in time order; only read the ones in range
+    first = self.partition(level, start)
+    last = self.partition(level, end)
+    base = os.path.join(self._root, level)
+    parts = sorted(os.listdir(base)) if os.path.isdir(base) else []
+    for part in parts:
+      if first <= part <= last:
+        points.extend(read_chunks(self.path(level, part, feed), start_ms, end_ms))
+
+    with self._lock:
+      s = self._series.get((feed, level))
+      if s:
+        points.extend(p for p in s.points if start_ms <= p[0] <= end_ms)
+    points.sort(key=lambda p: p[0])
+    if LEVELS[level]:
+      points = merge_rollups(points)
+    return [(p[0] / 1000.0,) + p[1] for p in points]
+
+  def prune(self):
+    """ Remove partitions which are older than the retention limits """
+    for (level, days) in self._retention.items():
+      base = os.path.join(self._root, level)
+      if not days or not os.path.isdir(base):
+        continue
+      oldest = self.partition(level, time.time() - days * 86400)
+      for part in sorted(os.listdir(base)):
+        if part >= oldest:
+          break
+        logger.info(f"Removing expired {level} partition {part}")
+        shutil.rmtree(os.path.join(base, part), ignore_errors=True)
+
+class LocalStore:
+  """ Sink which records everything from an Ingest reader into a Store """
+
+  def __init__(self, store, channel):
+    self.store = store
+    self._channel = channel
+    self._run = True
+
+  def end(self):
+    self._run = False
+    self._channel.wake()
+
+  def control_thread(self):
+    last_prune = 0
+    while self._run:
+      self._channel.wait(CHUNK_FLUSH_S / 10)
+      for data in self._channel.drain():
+        for (feed, value) in data.feeds():
+          self.store.append(feed, data.timestamp, value)
+      self.store.flush(CHUNK_FLUSH_S)
+      if time.time() - last_prune > 86400:
+        last_prune = time.time()
+        self.store.prune()
+    self.store.close()
+
+if __name__ == "__main__":
+
+  import sys
+  import tempfile
+  import random
+
+  logging.basicConfig(level=logging.INFO)
+
+  # Store a day of 250ms samples and report size and query times
+  root = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+  store = Store(root)
+  t0 = time.time() - 86400
+  v = 65.0
+  begin = time.time()
+  for i in range(4 * 86400):
+    v += random.gauss(0, 0.01)
+    store.append('test-temp', t0 + i * 0.25, round(v, 3))
+  store.close()
+  print(f"append: {4 * 86400 / (time.time() - begin):.0f} samples/s")
+
+  size = sum(os.path.getsize(os.path.join(d, f))
+             for (d, _, fs) in os.walk(root) for f in fs)
+  print(f"{root}: {size} bytes ({size / (4 * 86400):.2f} bytes/sample incl. rollups)")
+  for level in LEVELS:
+    begin = time.time()
+    n = len(store.query('test-temp', t0, t0 + 86400, level))
+    print(f"query {level}: {n} points in {time.time() - begin:.3f}s")
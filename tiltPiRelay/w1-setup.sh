@@ -1,6 +1,9 @@
 #!/bin/bash
 set -e
 
+# Group of the service user allowed to write the w1_therm attributes
+W1_GROUP=${W1_GROUP:-pi}
+
 LOAD_CMDS=("dtoverlay w1-gpio gpiopin=23 pullup=0",
 "dtoverlay w1-gpio gpiopin=27 pullup=0",
 "dtoverlay w1-gpio gpiopin=17 pullup=0",
@@ -24,6 +27,18 @@ then
       ${LOAD_CMDS[$i]}
     fi
   done
+
+  # Let the service (and only its group) start bulk conversions and
+  # change sensor resolution
+  for ATTR in /sys/bus/w1/devices/w1_bus_master*/therm_bulk_read \
+              /sys/bus/w1/devices/28-*/resolution
+  do
+    if [[ -e ${ATTR} ]]
+    then
+      chgrp ${W1_GROUP} ${ATTR}
+      chmod g+w ${ATTR}
+    fi
+  done
 elif [[ $1 == "unload" ]]
 then
   if [[ $(compgen -G "/sys/bus/w1/devices/28-*" | wc -l) -ne 0 ]]
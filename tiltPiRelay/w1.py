@@ -0,0 +1,260 @@
+import os
+import logging
+import threading
+
+"""
+One-wire device registry
+
+Keeps track of the temperature sensors on every one-wire bus so the temp
+readers don't have to walk sysfs themselves.  The w1 tree is scanned once
+at startup and each sensor's 'temperature' attribute is opened and kept
+open; a reading is a single pread() at offset 0, which makes sysfs run a
+fresh conversion, instead of glob + open + read + close every time.
+
+sysfs doesn't deliver inotify events when one-wire slaves come and go, so
+probes that are plugged in or removed are picked up by a slow background
+rescan (rescan_thread).  A read which fails (probe unplugged) closes the
+handle straight away and the next rescan opens it again if the probe is
+back.  A bus without a sensor is warned about once, not on every read.
+
+A bus can have any number of sensors, each addressed by its ROM ID (the
+sysfs directory name, e.g. 28-0316a2794aff).  Readers that don't give a
+ROM ID get the first sensor on the bus that nobody has claimed by ID.
+
+The conversion resolution (9-12 bits) of each sensor can be read and set
+through the w1_therm 'resolution' attribute; writing it needs write
+access to sysfs (see w1-setup.sh).
+
+"""
+
+logger = logging.getLogger('tiltpirelay.w1')
+
+W1_DEVICES = '/sys/bus/w1/devices/'
+BUS_PREFIX = 'w1_bus_master'
+# Slave family codes handled by the w1_therm driver (28- is the DS18B20)
+THERM_FAMILIES = ('28-', '10-', '22-', '3b-', '42-')
+RESCAN_S = 10.0
+READ_SIZE = 64
+RESOLUTIONS = range(9, 13)
+# DS18B20 worst case conversion time for each resolution
+CONV_TIME_S = { 9: 0.094, 10: 0.188, 11: 0.375, 12: 0.750 }
+
+class Handle:
+  """
+  Open sysfs attribute.  The fd is only closed once no reader is using
+  it, so a rescan can't close it (and the number be reused for another
+  file) in the middle of a read.  users/closing are guarded by the
+  registry lock.
+  """
+  __slots__ = ('fd', 'users', 'closing')
+
+  def __init__(self, fd):
+    self.fd = fd
+    self.users = 0
+    self.closing = False
+
+class W1Registry:
+
+  def __init__(self, root=W1_DEVICES, rescan=RESCAN_S):
+    self._root = root
+    self._rescan = rescan
+    self._lock = threading.Lock()
+    self._end = threading.Event()
+    self._sensors = {}  # bus -> {rom: Handle}
+    self._bulk = {}     # bus -> Handle of therm_bulk_read
+    self._warned = set()
+    self._claimed = set()
+    self.scans = 0
+    self.scan()
+
+  def scan(self):
+    """ Open any new sensors and forget any that have gone """
+    if self._end.is_set():
+      return
+    found = {}
+    try:
+      buses = [e.name for e in os.scandir(self._root) if e.name.startswith(BUS_PREFIX)]
+    except OSError:
+      buses = []
+    for bus in buses:
+      try:
+        found[bus] = sorted(e.name for e in os.scandir(self._root + bus)
+                            if e.name.startswith(THERM_FAMILIES))
+      except OSError:
+        found[bus] = []
+
+    with self._lock:
+      if self._end.is_set():
+        return
+      self.scans += 1
+      for (bus, roms) in found.items():
+        fds = self._sensors.setdefault(bus, {})
+        for rom in roms:
+          if rom not in fds:
+            try:
+              fds[rom] = Handle(os.open(f"{self._root}{bus}/{rom}/temperature", os.O_RDONLY))
+              logger.info(f"Found temp sensor {rom} on bus {bus}")
+              self._warned.discard((bus, rom))
+              self._warned.discard((bus, None))
+            except OSError as e:
+              logger.debug(f"Can't open temp sensor {rom} on bus {bus}: {e}")
+        for rom in [r for r in fds if r not in roms]:
+          logger.warning(f"Temp sensor {rom} removed from bus {bus}")
+          self._close(fds.pop(rom))
+        if bus not in self._bulk:
+          try:
+            self._bulk[bus] = Handle(os.open(f"{self._root}{bus}/therm_bulk_read", os.O_WRONLY))
+          except OSError:
+            self._bulk[bus] = None
+      for bus in [b for b in self._sensors if b not in found]:
+        self._close_bus(bus)
+
+  def _close_bus(self, bus):
+    for h in self._sensors.pop(bus, {}).values():
+      self._close(h)
+    h = self._bulk.pop(bus, None)
+    if h is not None:
+      self._close(h)
+
+  def _close(self, h):
+    """ Close a handle now, or when its last reader is done (lock held) """
+    h.closing = True
+    if not h.users:
+      os.close(h.fd)
+
+  def _acquire(self, h):
+    h.users += 1
+    return h.fd
+
+  def _release(self, h):
+    with self._lock:
+      h.users -= 1
+      if h.closing and not h.users:
+        os.close(h.fd)
+
+  def sensors(self, bus):
+    """ ROM IDs of the sensors currently on the bus """
+    with self._lock:
+      return sorted(self._sensors.get(bus, {}))
+
+  def find(self, rom):
+    """ Bus the sensor is on, or None if it isn't present """
+    with self._lock:
+      for (bus, fds) in self._sensors.items():
+        if rom in fds:
+          return bus
+    return None
+
+  def claim(self, rom):
+    """ Reserve a sensor for a reader addressing it by ROM ID """
+    with self._lock:
+      self._claimed.add(rom)
+
+  def rom(self, bus, rom=None):
+    """ ROM ID read() would use for this bus and rom """
+    with self._lock:
+      return self._rom(bus, rom)
+
+  def _rom(self, bus, rom):
+    if rom is None:
+      rom = min((r for r in self._sensors.get(bus, {}) if r not in self._claimed), default=None)
+    return rom
+
+  def read(self, bus, rom=None):
+    """
+    Raw 'temperature' value of a sensor (the first one on the bus if rom
+    isn't given), or None if there isn't one
+    """
+    with self._lock:
+      want = rom
+      rom = self._rom(bus, rom)
+      h = self._sensors.get(bus, {}).get(rom)
+      if h is None:
+        if (bus, want) not in self._warned:
+          self._warned.add((bus, want))
+          logger.warning(f"No temp sensor {want} found on bus {bus}" if want else
+                         f"No temp sensor found on bus {bus}")
+        return None
+      fd = self._acquire(h)
+    # Don't hold the lock through the conversion; other buses read in parallel
+    try:
+      data = os.pread(fd, READ_SIZE, 0)
+    except OSError as e:
+      logger.warning(f"Temp sensor {rom} on bus {bus} failed: {e}")
+      with self._lock:
+        if self._sensors.get(bus, {}).get(rom) is h:
+          self._close(self._sensors[bus].pop(rom))
+      return None
+    finally:
+      self._release(h)
+    lines = data.split()
+    return lines[-1].decode() if lines else None
+
+  def resolution(self, bus, rom=None):
+    """ Conversion resolution in bits, or None if it can't be read """
+    with self._lock:
+      rom = self._rom(bus, rom)
+    try:
+      with open(f"{self._root}{bus}/{rom}/resolution") as f:
+        return int(f.read())
+    except (OSError, ValueError, TypeError):
+      return None
+
+  def set_resolution(self, bus, bits, rom=None):
+    """ Set the conversion resolution; returns False if it couldn't be """
+    if bits not in RESOLUTIONS:
+      raise ValueError(f"Resolution must be 9-12 bits, not {bits}")
+    with self._lock:
+      rom = self._rom(bus, rom)
+    if rom is None:
+      return False
+    try:
+      with open(f"{self._root}{bus}/{rom}/resolution", 'w') as f:
+        f.write(f"{bits}\n")
+      return True
+    except OSError as e:
+      if (bus, rom, 'resolution') not in self._warned:
+        self._warned.add((bus, rom, 'resolution'))
+        logger.warning(f"Can't set resolution of temp sensor {rom} on bus {bus}: {e}")
+      return False
+
+  def trigger(self, bus):
+    """ Start a conversion on every sensor on the bus (if supported) """
+    with self._lock:
+      h = self._bulk.get(bus)
+      if h is None:
+        return False
+      fd = self._acquire(h)
+    try:
+      os.pwrite(fd, b'trigger\n', 0)
+      return True
+    except OSError as e:
+      logger.warning(f"Bulk conversion failed on bus {bus}: {e}")
+      return False
+    finally:
+      self._release(h)
+
+  def step(self):
+    """ Rescan; returns the seconds until the next rescan """
+    self.scan()
+    return self._rescan
+
+  def rescan_thread(self):
+    while not self._end.wait(self._rescan):
+      self.scan()
+
+  def end(self):
+    """ Stop rescanning and close the sensors """
+    with self._lock:
+      self._end.set()
+      for bus in list(self._sensors):
+        self._close_bus(bus)
+
+_shared = None
+
+def registry():
+  """ Registry shared by all the temp readers """
+  global _shared
+  if _shared is None:
+    _shared = W1Registry()
+  return _shared